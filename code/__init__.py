@@ -3,4 +3,6 @@ from .blockchain import Block
 from .blockchain import Blockchain
 from .blockchain import Transaction
 from .blockchain_app import parse_arguments
+from .metrics import REGISTRY
 from .store import Storage
+from .async_store import AsyncStorage
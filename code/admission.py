@@ -0,0 +1,90 @@
+"""
+Admission control of the transactions submitted to a node (`/put`).
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    __slots__ = ("_rate", "_burst", "_tokens", "_last")
+
+    def __init__(self, rate, burst, now):
+        """Init a full bucket of `burst` tokens, refilled at `rate`
+        tokens per second.
+        """
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = now
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def take(self, now):
+        """
+        Takes a token. Returns 0 if one was available, otherwise the
+        number of seconds until the next token.
+        """
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._rate
+
+
+
+class AdmissionControl:
+    def __init__(self, rate = 0, burst = 10, max_pending = 0, retry_after = 10,
+                    max_clients = 10000, clock = time.monotonic):
+        """Init the admission control.
+
+        Each client (the address it connects from, which it cannot choose
+        unlike the origin of its transactions) may submit `rate` transactions
+        per second on average, with bursts of `burst` transactions (token
+        bucket), and no transaction is admitted while `max_pending`
+        transactions are waiting in the pool. A limit of 0 disables it.
+        A client refused because the pool is full is asked to retry after
+        `retry_after` seconds (a block time).
+
+        At most `max_clients` buckets are kept: a new client replaces the
+        one that has been idle the longest, whose bucket has most likely
+        refilled.
+        """
+        self._rate = rate
+        self._burst = burst
+        self._max_pending = max_pending
+        self._retry_after = retry_after
+        self._max_clients = max_clients
+        self._clock = clock
+        self._buckets = {} #Buckets by client, the least recently used first
+        self._lock = threading.Lock()
+
+    def admit(self, client, pending):
+        """
+        Decides if a transaction of `client` enters a pool of `pending`
+        transactions.
+
+        Returns:
+        ----------
+        - a tuple with the reason of the refusal {mempool, rate} and the
+            number of seconds after which the client should retry,
+            None if the transaction is admitted
+        """
+        if self._max_pending and pending >= self._max_pending:
+            return ("mempool", self._retry_after)
+        if not self._rate:
+            return None
+
+        with self._lock:
+            now = self._clock()
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                bucket = TokenBucket(self._rate, self._burst, now)
+                while len(self._buckets) >= self._max_clients:
+                    del self._buckets[next(iter(self._buckets))]
+            self._buckets[client] = bucket
+            wait = bucket.take(now)
+        if wait:
+            return ("rate", wait)
+        return None
@@ -0,0 +1,185 @@
+"""
+Asynchronous KeyChain key-value store.
+"""
+import asyncio
+import json
+import aiohttp
+
+from store import backoff_delay, launch_node
+
+
+class AsyncCallback:
+    def __init__(self, storage, key, value):
+        self._storage = storage
+        self._key = key
+        self._value = value
+
+    async def wait(self):
+        """Wait until the transaction appears in the blockchain."""
+        timeout = 30
+        while(await self.completed() != self._value):
+            await asyncio.sleep(1)
+            timeout -= 1
+            if(timeout < 0):
+                print("Time out reached in the wait...")
+                break
+
+    async def completed(self):
+        """Polls the blockchain to check if the data is available."""
+        return await self._storage.retrieve(self._key)
+
+
+
+class AsyncStorage():
+
+    def __init__(self, bootstrap, miner, port = 5000, server = "flask",
+                 max_connections = 1000, max_retries = 5):
+        """
+        Same as `Storage`, but every operation is a coroutine sharing
+        a single pool of HTTP connections, so that a single event loop
+        can keep thousands of operations in flight.
+
+        The node is only launched: use `await AsyncStorage.create(...)`
+        to also wait, without blocking the event loop, until it is ready.
+        """
+        self._max_retries = max_retries
+        self.blockchain_app, self._address = launch_node(bootstrap, miner, port, server)
+        self._max_connections = max_connections
+        self._session = None
+
+    @classmethod
+    async def create(cls, bootstrap, miner, port = 5000, server = "flask",
+                     max_connections = 1000, max_retries = 5, timeout = 30):
+        """
+        Launch the node and returns the storage once the node
+        reports that it is ready.
+        """
+        storage = cls(bootstrap, miner, port, server, max_connections, max_retries)
+        try:
+            await storage._wait_ready(timeout)
+        except BaseException:
+            await storage.close()
+            raise
+        return storage
+
+    async def _wait_ready(self, timeout = 30):
+        """
+        Readiness handshake of `store.wait_ready`, polling the `/ready`
+        route of the node from the event loop.
+        """
+        url = "http://{}/ready".format(self._address)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            if self.blockchain_app.poll() is not None:
+                raise RuntimeError("The blockchain node exited during startup")
+            try:
+                async with self._get_session().get(url, timeout=aiohttp.ClientTimeout(total=1)) as result:
+                    if (await result.json(content_type=None))["ready"]:
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+                # The server is not listening yet
+                pass
+            await asyncio.sleep(0.05)
+        raise RuntimeError("The blockchain node is not ready after {} seconds".format(timeout))
+
+    def _get_session(self):
+        """
+        Returns the pooled HTTP session, creating it in the running loop
+        on first use.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._max_connections)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                timeout=aiohttp.ClientTimeout(total=10))
+        return self._session
+
+    async def _get(self, path, data):
+        """
+        Send a request to the node and returns the decoded answer,
+        or None if the node did not answer with a 200.
+        """
+        url = "http://{}/{}".format(self._address, path)
+        async with self._get_session().get(url, data=json.dumps(data)) as result:
+            if result.status != 200:
+                return None
+            # Flask answers with a text/html content type
+            return await result.json(content_type=None)
+
+    async def put(self, key, value, block=True):
+        """
+        Puts the specified key and value on the Blockchain.
+        The block flag indicates whether the call should wait until the value
+        has been put onto the blockchain, or if an error occurred.
+        """
+        data = {"key": key, "value": value, "origin": self._address}
+        url = "http://{}/put".format(self._address)
+        for attempt in range(self._max_retries + 1):
+            async with self._get_session().get(url, data=json.dumps(data)) as result:
+                if result.status == 200:
+                    break
+                if result.status != 429:
+                    print("Unable to put transaction on the blockchain")
+                    return
+                # The node is overloaded, retry later
+                answer = await result.json(content_type=None)
+            if attempt == self._max_retries:
+                print("Unable to put transaction on the blockchain (node overloaded)")
+                return
+            await asyncio.sleep(backoff_delay(attempt, answer.get("retry_after")))
+
+        callback = AsyncCallback(self, key, value)
+        if block:
+            await callback.wait()
+        return callback
+
+    async def retrieve(self, key):
+        """
+        Searches the most recent value of the specified key.
+        """
+        result = await self._get("retrieve", {"key": key})
+        if result is None:
+            print("Unable to retrieve value from the blockchain")
+            return
+        return result["value"]
+
+    async def retrieve_all(self, key):
+        """
+        Retrieves all values associated with the specified key on the
+        complete blockchain.
+        """
+        result = await self._get("retrieve_all", {"key": key})
+        if result is None:
+            print("Unable to retrieve all values from the blockchain")
+            return
+        return result["values"]
+
+    async def close(self):
+        """
+        Close the pooled HTTP session and kill the flask application.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self.blockchain_app.poll() is None:
+            self.blockchain_app.kill()
+            self.blockchain_app.wait()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __del__(self):
+        """
+        Kill the flask application when the Storage is deleted, and close
+        the HTTP session if it is still open (from its event loop, if it runs).
+        """
+        if self._session is not None and not self._session.closed:
+            try:
+                asyncio.get_running_loop().create_task(self._session.close())
+            except RuntimeError:
+                # No running loop: the connections are dropped with the session
+                pass
+        self.blockchain_app.kill()
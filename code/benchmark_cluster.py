@@ -0,0 +1,373 @@
+"""
+Cluster benchmark: throughput and latency of a local KeyChain network.
+
+Launches `--nodes` miners (blockchain_app.py) on loopback ports, drives a
+workload of puts and retrieves (`--retrieve-ratio`) against them and appends
+one CSV row per configuration with:
+- the requests answered per second during the workload,
+- the transactions committed per second,
+- the put-to-commit latency percentiles,
+- the retrieve latency percentiles,
+- the bytes sent and the CPU usage per node.
+
+Every combination of the swept parameters (difficulty, retargeting,
+nodes, block size, broadcast mode and WSGI server) is measured. The
+difficulty is the initial one: it only stays fixed without retargeting
+(`--retarget-interval 0`, the default).
+
+Usage:
+    python benchmark_cluster.py --difficulty 3 4 --nodes 2 4 \
+        --retarget-interval 0 20 --block-time 5 \
+        --block-size 0 50 --broadcast reliable best-effort --server flask waitress \
+        --mode open --rate 10 --retrieve-ratio 0.5 --duration 60 --output results.csv
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from requests import get, exceptions
+
+from metrics import percentile
+from store import wait_ready
+
+
+FIELDS = ["difficulty", "retarget_interval", "block_time", "nodes", "block_size", "broadcast", "server", "mode", "rate",
+          "clients", "retrieve_ratio", "duration", "requests_per_second", "submitted", "refused", "committed", "throughput",
+          "latency_p50", "latency_p90", "latency_p99", "retrieves", "retrieve_latency_p50",
+          "retrieve_latency_p99", "bytes_sent_per_node", "cpu_per_node"]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("KeyChain cluster benchmark")
+    parser.add_argument("--difficulty", type=int, nargs="+", default=[4],
+                        help="Initial difficulty levels to measure")
+    parser.add_argument("--retarget-interval", type=int, nargs="+", default=[0],
+                        help="Numbers of blocks between two difficulty adjustments "
+                        "to measure (0 keeps the initial difficulty)")
+    parser.add_argument("--block-time", type=float, nargs="+", default=[10],
+                        help="Targeted times between two blocks to measure "
+                        "(with --retarget-interval)")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[3],
+                        help="Cluster sizes to measure")
+    parser.add_argument("--block-size", type=int, nargs="+", default=[0],
+                        help="Maximum numbers of transactions per block (0 for no limit)")
+    parser.add_argument("--broadcast", type=str, nargs="+", default=["reliable"],
+                        choices=["reliable", "best-effort"],
+                        help="Broadcast modes to measure")
+    parser.add_argument("--server", type=str, nargs="+", default=["flask"],
+                        choices=["flask", "waitress"],
+                        help="WSGI servers of the nodes to measure")
+    parser.add_argument("--mode", type=str, default="open",
+                        choices=["open", "closed", "saturate"],
+                        help="Open loop (operations at a fixed rate), closed loop "
+                        "(each client waits for the commit of its put) or saturate "
+                        "(each client sends its operations back to back)")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="Operations per second of the open loop")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="Number of clients of the closed and saturate loops")
+    parser.add_argument("--retrieve-ratio", type=float, default=0,
+                        help="Fraction of the operations that retrieve a key "
+                        "already put instead of putting a new one")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="Duration of the workload in seconds")
+    parser.add_argument("--drain", type=float, default=30,
+                        help="Time left to commit the pending puts after the workload")
+    parser.add_argument("--base-port", type=int, default=6000,
+                        help="Port of the first node")
+    parser.add_argument("--node-args", type=str, default="",
+                        help="Extra arguments passed to every node")
+    parser.add_argument("--output", type=str, default="benchmark_cluster.csv",
+                        help="CSV file the results are appended to")
+    return parser.parse_args()
+
+
+def start_cluster(nb_nodes, difficulty, retarget_interval, block_time, block_size,
+                  broadcast, server, arguments):
+    """
+    Launch the nodes, the first one being the bootstrap node of the others.
+    Returns the list of (process, address).
+    """
+    nodes = []
+    bootstrap = "127.0.0.1:{}".format(arguments.base_port)
+    for i in range(nb_nodes):
+        port = arguments.base_port + i
+        command = [sys.executable, "blockchain_app.py", "--miner",
+                   "--port", str(port), "--bootstrap", bootstrap,
+                   "--difficulty", str(difficulty),
+                   "--retarget-interval", str(retarget_interval),
+                   "--block-time", str(block_time), "--block-size", str(block_size),
+                   "--broadcast", broadcast, "--server", server,
+                   "--log-level", "WARNING"]
+        command += arguments.node_args.split()
+        process = subprocess.Popen(command)
+        address = "127.0.0.1:{}".format(port)
+        nodes.append((process, address))
+        wait_ready(address, process)
+    return nodes
+
+
+def stop_cluster(nodes):
+    for process, _ in nodes:
+        process.kill()
+        process.wait()
+
+
+def cpu_seconds(pid):
+    """
+    Returns the CPU time (user + system) used by a process, None if
+    it cannot be read (Linux only).
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def bytes_sent(address):
+    """
+    Returns the bytes sent by a node, read from its metrics.
+    """
+    text = get("http://{}/metrics".format(address), timeout=10).text
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith("keychain_bytes_sent_total"):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+class CommitMonitor:
+    def __init__(self, address):
+        """Polls the chain of a node to record the commit time of each key.
+        Only the blocks added since the previous poll are downloaded.
+        """
+        self._address = address
+        self._next_index = 0
+        self._commits = {}
+        self._events = {}
+        self._lock = threading.Lock()
+        self._running = True
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def expect(self, key):
+        """
+        Returns an event set once the key is committed.
+        """
+        with self._lock:
+            event = self._events.setdefault(key, threading.Event())
+            if key in self._commits:
+                event.set()
+        return event
+
+    def commits(self):
+        with self._lock:
+            return dict(self._commits)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def _poll(self):
+        while self._running:
+            try:
+                result = get("http://{}/blocks".format(self._address),
+                             params={"start": self._next_index}, timeout=10)
+                # 404: no new block
+                chain = result.json()["chain"] if result.status_code == 200 else []
+            except (exceptions.RequestException, ValueError):
+                time.sleep(0.5)
+                continue
+            now = time.time()
+            with self._lock:
+                for block in map(json.loads, chain):
+                    self._next_index = block["_index"] + 1
+                    for transaction in block["_transactions"]:
+                        key = transaction["key"]
+                        if key not in self._commits:
+                            self._commits[key] = now
+                            if key in self._events:
+                                self._events[key].set()
+            time.sleep(0.5)
+
+
+def put(address, key):
+    """
+    Puts a key on a node.
+
+    Returns:
+    ----------
+    - the time of the put, None if it failed
+    - the status code of the answer, None if the node did not answer
+    """
+    start = time.time()
+    try:
+        result = get("http://{}/put".format(address),
+                     data=json.dumps({"key": key, "value": start, "origin": "benchmark"}),
+                     timeout=10)
+    except exceptions.RequestException:
+        return None, None
+    if result.status_code != 200:
+        # Refused (429) or failed: the key will never be committed
+        return None, result.status_code
+    return start, result.status_code
+
+
+def retrieve(address, key):
+    """
+    Retrieves a key from a node, returns the latency of the request
+    or None if it failed.
+    """
+    start = time.time()
+    try:
+        result = get("http://{}/retrieve".format(address),
+                     data=json.dumps({"key": key}), timeout=10)
+    except exceptions.RequestException:
+        return None
+    if result.status_code != 200:
+        return None
+    return time.time() - start
+
+
+def run_workload(nodes, monitor, arguments):
+    """
+    Runs the workload.
+
+    Returns:
+    ----------
+    - the put time of each key
+    - the number of puts refused by the nodes
+    - the latency of each retrieve
+    """
+    puts = {}
+    refused = [0]
+    retrieves = []
+    lock = threading.Lock()
+    addresses = [address for _, address in nodes]
+    end = time.time() + arguments.duration
+    counter = itertools.count()
+
+    def submit():
+        key = "bench-{}".format(next(counter))
+        start, status = put(random.choice(addresses), key)
+        with lock:
+            if start is not None:
+                puts[key] = start
+            elif status == 429:
+                refused[0] += 1
+        return key, start
+
+    def lookup():
+        with lock:
+            keys = list(puts) if puts else ["bench-0"]
+        latency = retrieve(random.choice(addresses), random.choice(keys))
+        if latency is not None:
+            with lock:
+                retrieves.append(latency)
+
+    def operation():
+        # Retrieve a key already put, or put a new one
+        if random.random() < arguments.retrieve_ratio:
+            lookup()
+            return None, None
+        return submit()
+
+    if arguments.mode == "open":
+        interval = 1.0 / arguments.rate
+        next_operation = time.time()
+        while next_operation < end:
+            threading.Thread(target=operation, daemon=True).start()
+            next_operation += interval
+            time.sleep(max(0, next_operation - time.time()))
+    else:
+        def client():
+            while time.time() < end:
+                key, start = operation()
+                if start is not None and arguments.mode == "closed":
+                    monitor.expect(key).wait(max(0, end - time.time()))
+        clients = [threading.Thread(target=client) for _ in range(arguments.clients)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+    return puts, refused[0], retrieves
+
+
+def measure(difficulty, retarget_interval, block_time, nb_nodes, block_size,
+            broadcast, server, arguments):
+    """
+    Measures one configuration and returns its CSV row.
+    """
+    nodes = start_cluster(nb_nodes, difficulty, retarget_interval, block_time,
+                          block_size, broadcast, server, arguments)
+    try:
+        monitor = CommitMonitor(nodes[0][1])
+        cpu_start = [cpu_seconds(process.pid) for process, _ in nodes]
+        bytes_start = [bytes_sent(address) for _, address in nodes]
+        start = time.time()
+
+        puts, refused, retrieves = run_workload(nodes, monitor, arguments)
+        workload = time.time() - start
+
+        # Leave time to commit the pending puts
+        deadline = time.time() + arguments.drain
+        while time.time() < deadline and len(monitor.commits().keys() & puts.keys()) < len(puts):
+            time.sleep(0.5)
+        elapsed = time.time() - start
+        monitor.stop()
+
+        cpu_end = [cpu_seconds(process.pid) for process, _ in nodes]
+        bytes_end = [bytes_sent(address) for _, address in nodes]
+    finally:
+        stop_cluster(nodes)
+
+    commits = monitor.commits()
+    latencies = [commits[key] - puts[key] for key in puts if key in commits]
+    cpu = [(e - s) / elapsed for s, e in zip(cpu_start, cpu_end)
+           if s is not None and e is not None]
+    return {"difficulty": difficulty, "retarget_interval": retarget_interval,
+            "block_time": block_time, "nodes": nb_nodes, "block_size": block_size,
+            "broadcast": broadcast, "server": server, "mode": arguments.mode,
+            "rate": arguments.rate, "clients": arguments.clients,
+            "retrieve_ratio": arguments.retrieve_ratio, "duration": arguments.duration,
+            "requests_per_second": (len(puts) + refused + len(retrieves)) / workload,
+            "submitted": len(puts), "refused": refused,
+            "committed": len(latencies), "throughput": len(latencies) / elapsed,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p90": percentile(latencies, 0.9),
+            "latency_p99": percentile(latencies, 0.99),
+            "retrieves": len(retrieves),
+            "retrieve_latency_p50": percentile(retrieves, 0.5),
+            "retrieve_latency_p99": percentile(retrieves, 0.99),
+            "bytes_sent_per_node": sum(e - s for s, e in zip(bytes_start, bytes_end)) / nb_nodes,
+            "cpu_per_node": sum(cpu) / len(cpu) if cpu else None}
+
+
+def main(arguments):
+    new_file = not os.path.exists(arguments.output)
+    with open(arguments.output, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+        for configuration in itertools.product(arguments.difficulty,
+                                               arguments.retarget_interval,
+                                               arguments.block_time, arguments.nodes,
+                                               arguments.block_size, arguments.broadcast,
+                                               arguments.server):
+            row = measure(*configuration, arguments)
+            print(", ".join("{}={}".format(field, row[field]) for field in FIELDS))
+            writer.writerow(row)
+            f.flush()
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
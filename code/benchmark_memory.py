@@ -0,0 +1,69 @@
+"""
+Memory benchmark: bytes held per committed transaction.
+
+Simulates what a node keeps in memory: the transactions are received
+through the `transaction` broadcast, then the blocks containing them
+through the `block` broadcast, and the blocks are kept in the chain.
+
+Usage: python benchmark_memory.py --transactions 100000 --block-size 100
+"""
+import argparse
+import json
+import tracemalloc
+
+from blockchain import Block, Transaction, TransactionEncoder
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("KeyChain memory benchmark")
+    parser.add_argument("--transactions", type=int, default=100000,
+                        help="Number of committed transactions")
+    parser.add_argument("--block-size", type=int, default=100,
+                        help="Number of transactions per block")
+    parser.add_argument("--keys", type=int, default=1000,
+                        help="Number of distinct keys")
+    return parser.parse_args()
+
+
+def make_messages(arguments):
+    """
+    Returns the transaction and block messages (JSON) received by a node.
+    """
+    transactions = []
+    blocks = []
+    previous_hash = "0"
+    for i in range(0, arguments.transactions, arguments.block_size):
+        block_transactions = []
+        for j in range(i, min(i + arguments.block_size, arguments.transactions)):
+            t = {"key": "key-{}".format(j % arguments.keys),
+                 "value": "value-{}".format(j),
+                 "origin": "127.0.0.1:5000"}
+            transactions.append(json.dumps(t, sort_keys=True))
+            block_transactions.append(Transaction(t["key"], t["value"], t["origin"]))
+        block = Block(len(blocks) + 1, block_transactions, float(i), previous_hash)
+        previous_hash = block.compute_hash()
+        blocks.append(json.dumps(block.to_dict(), sort_keys=True, cls=TransactionEncoder))
+    return transactions, blocks
+
+
+def main(arguments):
+    transactions, blocks = make_messages(arguments)
+
+    tracemalloc.start()
+    pending = []
+    for message in transactions:
+        t = json.loads(message)
+        pending.append(Transaction(t["key"], t["value"], t["origin"]))
+    chain = [Block.from_dict(json.loads(message)) for message in blocks]
+    # The transactions are committed: they leave the pool
+    pending = []
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{} transactions in {} blocks".format(arguments.transactions, len(chain)))
+    print("Bytes per committed transaction: {:.1f} (peak {:.1f})".format(
+        current / arguments.transactions, peak / arguments.transactions))
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
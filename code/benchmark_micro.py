@@ -0,0 +1,133 @@
+"""
+Micro-benchmarks of the hot paths of a node, on synthetic chains.
+
+Requires pytest-benchmark. Run from this directory with:
+    python -m pytest --import-mode=importlib benchmark_micro.py
+
+The shape of the synthetic chains is set by environment variables:
+- KEYCHAIN_BENCH_LENGTH: blocks of the master chain (default 1000)
+- KEYCHAIN_BENCH_TRANSACTIONS: transactions per block (default 10)
+- KEYCHAIN_BENCH_KEYS: distinct keys (default 100)
+- KEYCHAIN_BENCH_BRANCHES: competing branches (default 4)
+- KEYCHAIN_BENCH_DEPTH: blocks of the longest branch (default 1, a branch
+    of 2 blocks or more is committed to the master chain)
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from blockchain import Block, Blockchain, Transaction
+
+
+LENGTH = int(os.environ.get("KEYCHAIN_BENCH_LENGTH", 1000))
+TRANSACTIONS = int(os.environ.get("KEYCHAIN_BENCH_TRANSACTIONS", 10))
+KEYS = int(os.environ.get("KEYCHAIN_BENCH_KEYS", 100))
+BRANCHES = int(os.environ.get("KEYCHAIN_BENCH_BRANCHES", 4))
+DEPTH = int(os.environ.get("KEYCHAIN_BENCH_DEPTH", 1))
+
+
+def make_transactions(index, count):
+    return [Transaction("key-{}".format((index * count + i) % KEYS),
+                        "value-{}-{}".format(index, i), "127.0.0.1:5000")
+            for i in range(count)]
+
+
+def make_block(parent, transactions, salt = 0):
+    """
+    Returns a block following `parent`. The chains are built with the
+    largest target (difficulty 0), so that every block is a valid proof.
+    """
+    return Block(parent._index + 1, transactions, parent._timestamp + 10 + salt,
+                    parent.compute_hash(), target=parent._target)
+
+
+def make_blockchain():
+    """
+    Returns a node (not mining) with a master chain of LENGTH blocks
+    and BRANCHES competing branches, the first one being DEPTH blocks long.
+    """
+    blockchain = Blockchain(miner=False, unitTests=True, difficulty=0)
+    chain = blockchain.get_blocks()
+    for i in range(1, LENGTH):
+        chain.append(make_block(chain[-1], make_transactions(i, TRANSACTIONS)))
+
+    branches = blockchain.get_branches()
+    for b in range(BRANCHES):
+        branch = [make_block(chain[-1], make_transactions(LENGTH, TRANSACTIONS), salt=b)]
+        if b == 0:
+            for i in range(1, DEPTH):
+                branch.append(make_block(branch[-1], make_transactions(LENGTH + i, TRANSACTIONS)))
+        branches.append(branch)
+    blockchain._last_hash = branches[0][-1].compute_hash()
+    return blockchain
+
+
+@pytest.mark.parametrize("nb_transactions", [1, 100, 1000])
+def test_compute_hash(benchmark, nb_transactions):
+    block = Block(1, make_transactions(1, nb_transactions), time.time(), "0")
+
+    def compute_hash():
+        # Drop the cached hash
+        block._set_nonce(block._nonce + 1)
+        return block.compute_hash()
+
+    benchmark(compute_hash)
+
+
+def test_add_block_extend_branch(benchmark):
+    # The new block extends the longest branch, which gets committed
+    def setup():
+        blockchain = make_blockchain()
+        tip = blockchain.get_branches()[0][-1]
+        return (blockchain, make_block(tip, make_transactions(0, TRANSACTIONS))), {}
+
+    benchmark.pedantic(lambda blockchain, block: blockchain._add_block(block),
+                        setup=setup, rounds=20)
+
+
+def test_add_block_fork(benchmark):
+    # The new block competes with the branches on top of the master chain
+    def setup():
+        blockchain = make_blockchain()
+        tip = blockchain.get_blocks()[-1]
+        return (blockchain, make_block(tip, make_transactions(0, TRANSACTIONS),
+                                        salt=BRANCHES)), {}
+
+    benchmark.pedantic(lambda blockchain, block: blockchain._add_block(block),
+                        setup=setup, rounds=20)
+
+
+def test_confirm_block(benchmark):
+    # Confirmation of a foreign block by a miner with a full pool
+    def setup():
+        blockchain = make_blockchain()
+        blockchain._miner = True
+        tip = blockchain.get_branches()[0][-1]
+        transactions = make_transactions(0, TRANSACTIONS)
+        for transaction in transactions:
+            blockchain.add_transaction(transaction, broadcast=False)
+        return (blockchain, make_block(tip, transactions)), {}
+
+    benchmark.pedantic(lambda blockchain, block: blockchain.confirm_block(block),
+                        setup=setup, rounds=20)
+
+
+@pytest.fixture(scope="module")
+def blockchain():
+    return make_blockchain()
+
+
+def test_retrieve(benchmark, blockchain):
+    benchmark(blockchain.retrieve, "key-0")
+
+
+def test_retrieve_unknown_key(benchmark, blockchain):
+    # Worst case: the whole chain is scanned
+    benchmark(blockchain.retrieve, "unknown")
+
+
+def test_retrieve_all(benchmark, blockchain):
+    benchmark(blockchain.retrieve_all, "key-0")
@@ -9,89 +9,471 @@ import argparse
 import sys
 import operator
 import threading
-import copy 
+import multiprocessing
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from flask import Flask, request
 from requests import get, post, exceptions
-from broadcast import Broadcast, send_to_one
+from admission import AdmissionControl
+from broadcast import Broadcast, HttpTransport
+from values import ValueStore, REFERENCE, is_reference
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+#Largest possible target (any hash is a valid proof)
+MAX_TARGET = 2 ** 256 - 1
+
+
+#Length (hexadecimal characters) of the transaction ids of compact blocks
+SHORT_ID_LENGTH = 12
+#Number of blocks at the end of the master chain whose transactions are
+#served to the peers rebuilding a compact block (`/blockTransactions`)
+COMPACT_BLOCK_DEPTH = 10
+
+
+def difficulty_to_target(difficulty):
+    """
+    Returns the target equivalent to a proof requiring
+    `difficulty` leading hexadecimal zeros.
+    """
+    return 2 ** (256 - 4 * difficulty) - 1
+
+
+def block_work(target):
+    """
+    Returns the expected number of hashes needed to find
+    a proof for the target.
+    """
+    return (MAX_TARGET + 1) // (target + 1)
+
+
+def next_target(chain, retarget_interval, block_time, max_target = MAX_TARGET):
+    """
+    Returns the target of the block following the last block of `chain`.
+
+    Every `retarget_interval` blocks, the target is scaled by the ratio
+    between the observed and the configured block time over the last
+    `retarget_interval` blocks (clamped to a factor 4 either way).
+    Otherwise, or if `retarget_interval` is 0, the target of the parent
+    block is kept.
+
+    The target never exceeds `max_target`, the nodes passing the genesis
+    target: a block is only mined once transactions are pending, so the
+    idle time between two bursts of transactions counts as block time and
+    would otherwise lower the difficulty down to MAX_TARGET under light
+    traffic. The retargeting can thus only make mining harder than the
+    configured difficulty.
+
+    Arguments:
+    ----------
+    - `chain`: the last blocks (at least `retarget_interval`) of the chain
+    - `retarget_interval`: number of blocks between two adjustments
+                        (0 to disable them)
+    - `block_time`: targeted time between two blocks in seconds
+    - `max_target`: largest target (lowest difficulty) of a block
+    """
+    last_block = chain[-1]
+    if (not retarget_interval or (last_block._index + 1) % retarget_interval != 0 or
+        len(chain) < retarget_interval):
+        return last_block._target
+
+    first_block = chain[-retarget_interval]
+    expected = block_time * (retarget_interval - 1)
+    observed = last_block._timestamp - first_block._timestamp
+    observed = min(max(observed, expected / 4), expected * 4)
+    # Integer arithmetic (microseconds) so that every node computes the same target
+    target = last_block._target * int(observed * 1e6) // int(expected * 1e6)
+    return max(1, min(target, max_target))
 
 
 class TransactionEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Transaction):
-            return vars(obj)
+            return obj.to_dict()
         return json.JSONEncoder.default(self, obj)
 
 
 
 class Block:
-    def __init__(self, index, transactions, timestamp, previous_hash, nonce = 0):
-        """Init the properties of a block.
+    __slots__ = ("_index", "_transactions", "_timestamp", "_previous_hash",
+                 "_nonce", "_target", "_snapshot", "_hash")
+
+    def __init__(self, index, transactions, timestamp, previous_hash, nonce = 0,
+                    target = MAX_TARGET, snapshot = None):
+        """Init the properties of a block. The index is the height of the
+        block in the chain and the target the largest hash accepted as proof.
+        The snapshot, if any, is the hash of the state snapshot taken after
+        the previous block (see `Snapshot`).
+
+        Only the nonce of a block can change (while it is mined, see
+        `_set_nonce`), the transactions are stored in a tuple so that blocks
+        and branches can be shared without copies.
         """
-        self._index = index
-        self._transactions = transactions
-        self._timestamp = timestamp
-        self._previous_hash = previous_hash
-        self._nonce = nonce
+        object.__setattr__(self, "_index", index)
+        object.__setattr__(self, "_transactions", tuple(transactions))
+        object.__setattr__(self, "_timestamp", timestamp)
+        object.__setattr__(self, "_previous_hash", previous_hash)
+        object.__setattr__(self, "_nonce", nonce)
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_snapshot", snapshot)
+        object.__setattr__(self, "_hash", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Blocks are immutable (only the nonce changes, see `_set_nonce`)")
+
+    def __reduce__(self):
+        # The cached hash is not pickled
+        return (Block, (self._index, self._transactions, self._timestamp,
+                        self._previous_hash, self._nonce, self._target, self._snapshot))
+
+    @classmethod
+    def from_dict(cls, block):
+        """Returns the block described by a (JSON decoded) dictionary.
+        """
+        transactions = []
+        for t in block["_transactions"]:
+            transactions.append(Transaction(t["key"], t["value"], t["origin"]))
+        return cls(block["_index"],
+                    transactions,
+                    block["_timestamp"],
+                    block["_previous_hash"],
+                    block["_nonce"],
+                    block["_target"],
+                    block.get("_snapshot"))
+
+    def to_dict(self):
+        """Returns the contents of the block as a dictionary
+        (the hashed contents, compatible with `from_dict`).
+        """
+        block = {"_index": self._index,
+                "_transactions": self._transactions,
+                "_timestamp": self._timestamp,
+                "_previous_hash": self._previous_hash,
+                "_nonce": self._nonce,
+                "_target": self._target}
+        # Only blocks anchoring a snapshot have the field, so that the hash
+        # of the other blocks is unchanged
+        if self._snapshot is not None:
+            block["_snapshot"] = self._snapshot
+        return block
 
-    def proof(self, difficulty):
-        """Returns the proof of the current block.
+    def to_header_dict(self):
+        """Returns the contents of the block without its transactions,
+        with its hash.
         """
-        # print("Hash in proof",self.compute_hash())
-        return self.compute_hash().startswith('0' * difficulty)
+        block = self.to_dict()
+        del block["_transactions"]
+        block["_hash"] = self.compute_hash()
+        return block
+
+    def to_compact_dict(self):
+        """Returns the header of the block with its hash and the short ids
+        of its transactions (see `from_compact_dict`).
+        """
+        block = self.to_header_dict()
+        block["_short_ids"] = [t.get_id()[:SHORT_ID_LENGTH] for t in self._transactions]
+        return block
+
+    @classmethod
+    def from_compact_dict(cls, block, transactions):
+        """Returns the block described by a compact dictionary and the
+        transactions matching its short ids.
+        """
+        return cls(block["_index"],
+                    transactions,
+                    block["_timestamp"],
+                    block["_previous_hash"],
+                    block["_nonce"],
+                    block["_target"],
+                    block.get("_snapshot"))
+
+    def proof(self):
+        """Returns the proof of the current block, i.e. whether
+        its hash is below its target.
+        """
+        return check_proof(self.compute_hash(), self._target)
                 
     def get_transactions(self):
-        """Returns the list of transactions associated with the block.
+        """Returns the tuple of transactions associated with the block.
         """
         return self._transactions
 
     def compute_hash(self):
         """
-        Returns the hash of the block contents.
+        Returns the hash of the block contents (cached until the nonce changes).
+        """
+        if self._hash is None:
+            object.__setattr__(self, "_hash", self.hash_contents())
+        return self._hash
+
+    def hash_contents(self):
+        """
+        Returns the hash of the block contents, computed without the cache.
         """
-        block_string = json.dumps(self.__dict__, sort_keys=True, cls=TransactionEncoder)
+        block_string = json.dumps(self.to_dict(), sort_keys=True, cls=TransactionEncoder)
         return sha256(block_string.encode()).hexdigest()
 
+    def _set_nonce(self, nonce):
+        """
+        Sets the nonce of a block.
+        """
+        object.__setattr__(self, "_nonce", nonce)
+        object.__setattr__(self, "_hash", None)
+
     def _change_nonce(self, random = False):
         """
         Changes the nonce of a block.
         """
         if(random):
-            self._nonce = random.randint(1, sys.maxsize)
+            self._set_nonce(random.randint(1, sys.maxsize))
         else:
-            self._nonce += 1
+            self._set_nonce(self._nonce + 1)
 
     
 
+def check_proof(block_hash, target):
+    """
+    Returns True if the (hexadecimal) hash is a valid proof for the target.
+    """
+    return int(block_hash, 16) <= target
+
+
+
 class Transaction:
+    __slots__ = ("key", "value", "origin", "_id")
+
     def __init__(self, key, value, origin):
         """Init the transaction. A transaction typically involves
         some key, value and an origin (the one who put it onto the storage).
+
+        Transactions are immutable, so that the pool and the blocks share them
+        without copies. Keys and origins are interned since they repeat across
+        transactions.
+        """
+        if isinstance(key, str):
+            key = sys.intern(key)
+        if isinstance(origin, str):
+            origin = sys.intern(origin)
+        object.__setattr__(self, "key", key)
+        object.__setattr__(self, "value", value)
+        object.__setattr__(self, "origin", origin)
+        object.__setattr__(self, "_id", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Transactions are immutable")
+
+    def __reduce__(self):
+        return (Transaction, (self.key, self.value, self.origin))
+
+    def get_id(self):
+        """Returns the id (hash of the contents) of the transaction.
+        """
+        if self._id is None:
+            content = json.dumps(self.to_dict(), sort_keys=True)
+            object.__setattr__(self, "_id", sha256(content.encode()).hexdigest())
+        return self._id
+
+    def to_dict(self):
+        """Returns the contents of the transaction as a dictionary.
         """
-        self.key = key
-        self.value = value 
-        self.origin = origin
+        return {"key": self.key, "value": self.value, "origin": self.origin}
 
     def __eq__(self, other):
         """
         Overwrite of the equality test.
         """
-        return self.__dict__ == other.__dict__
+        return (isinstance(other, Transaction) and self.key == other.key and
+                self.value == other.value and self.origin == other.origin)
+
+    def __hash__(self):
+        return hash(self.get_id())
+
+
+
+
+class Snapshot:
+    __slots__ = ("_index", "_block_hash", "_state", "_history", "_hash")
+
+    def __init__(self, index, block_hash, state, history = None):
+        """Init a snapshot of the key-value store once the block `index`
+        (whose hash is `block_hash`) has been applied: the latest value of
+        every key and, optionally, all its values from the oldest to the
+        most recent.
+        """
+        self._index = index
+        self._block_hash = block_hash
+        self._state = state
+        self._history = history
+        self._hash = None
+
+    @classmethod
+    def empty(cls, history = False):
+        """Returns the snapshot preceding the genesis block.
+        """
+        return cls(-1, "0", {}, {} if history else None)
+
+    @classmethod
+    def from_dict(cls, snapshot):
+        """Returns the snapshot described by a (JSON decoded) dictionary.
+        """
+        history = None
+        if snapshot["_history"] is not None:
+            history = {key: tuple(values) for key, values in snapshot["_history"]}
+        return cls(snapshot["_index"],
+                    snapshot["_block_hash"],
+                    {key: value for key, value in snapshot["_state"]},
+                    history)
+
+    def to_dict(self):
+        """Returns the contents of the snapshot as a dictionary. The keys
+        are stored as sorted pairs since they are not always strings.
+        """
+        keys = sorted(self._state, key=json.dumps)
+        history = None
+        if self._history is not None:
+            history = [[key, self._history[key]] for key in keys]
+        return {"_index": self._index,
+                "_block_hash": self._block_hash,
+                "_state": [[key, self._state[key]] for key in keys],
+                "_history": history}
+
+    def compute_hash(self):
+        """
+        Returns the hash of the snapshot contents.
+        """
+        if self._hash is None:
+            snapshot_string = json.dumps(self.to_dict(), sort_keys=True)
+            self._hash = sha256(snapshot_string.encode()).hexdigest()
+        return self._hash
+
+    def apply(self, blocks):
+        """Returns the snapshot obtained by applying the blocks, which
+        must directly follow the block of this snapshot.
+        """
+        if not blocks:
+            return self
+        state = dict(self._state)
+        new_values = {}
+        for block in blocks:
+            for transaction in block.get_transactions():
+                state[transaction.key] = transaction.value
+                new_values.setdefault(transaction.key, []).append(transaction.value)
+
+        history = None
+        if self._history is not None:
+            history = dict(self._history)
+            for key, values in new_values.items():
+                history[key] = history.get(key, ()) + tuple(values)
+        return Snapshot(blocks[-1]._index, blocks[-1].compute_hash(), state, history)
+
+    def retrieve(self, key):
+        """Returns the latest value of the key, None if it is unknown.
+        """
+        return self._state.get(key)
+
+    def retrieve_all(self, key):
+        """Returns all the values of the key, from the most recent to the oldest,
+        or only the latest one if the history is not kept.
+        """
+        if self._history is not None:
+            return list(reversed(self._history.get(key, ())))
+        if key in self._state:
+            return [self._state[key]]
+        return []
+
+    def values(self):
+        """Returns the values of the snapshot (the history, if kept,
+        includes the latest values).
+        """
+        if self._history is not None:
+            return [value for values in self._history.values() for value in values]
+        return list(self._state.values())
 
 
 
 
 class Blockchain:
-    def __init__(self, port = 5000, miner = True, unitTests = False):
+    def __init__(self, port = 5000, miner = True, unitTests = False, difficulty = 4,
+                    block_time = 10, retarget_interval = 0, snapshot_interval = 0,
+                    snapshot_history = False, prune = False, block_size = 0,
+                    broadcast_mode = "reliable", profiler = None, transport = None,
+                    heartbeat = True, mining_thread = True, block_relay = "compact",
+                    sync_mode = "parallel", sync_range = 500, rate_limit = 0,
+                    rate_burst = 10, max_pending = 0, value_threshold = 0,
+                    compression = "none", validation_processes = None):
         """Init the blockchain.
+
+        The difficulty (number of leading hexadecimal zeros) sets the target
+        of the genesis block. If `retarget_interval` is not 0, the target is
+        then adjusted every `retarget_interval` blocks so that blocks are
+        mined every `block_time` seconds.
+
+        If `snapshot_interval` is not 0, every block whose index is a multiple
+        of it anchors the hash of the snapshot of the state after its parent
+        (with the version history of the keys if `snapshot_history`). Once such
+        a block is in the master chain, the snapshot is adopted and, if `prune`,
+        the blocks behind it are dropped. These three settings must be the same
+        on every node.
+
+        A mined block holds at most `block_size` transactions (0 for no limit).
+        If a `profiling.Profiler` is given, the mining thread is profiled.
+
+        With the `compact` block relay, a mined block is announced by its
+        header and the short ids of its transactions, the peers rebuilding it
+        from their pool (see `_rebuild_block`). The `full` relay sends it whole.
+
+        With the `parallel` sync mode, a joining node downloads the chain by
+        ranges of `sync_range` blocks from all the peers having the same last
+        block (see `_parallel_sync`). The `single` mode downloads it from one peer.
+        The chains are hashed by a pool of `validation_processes` processes,
+        or in the node process if None (see `validate_chain`).
+
+        The transactions submitted to the node are limited to `rate_limit`
+        per second and client (bursts of `rate_burst`), and refused while
+        `max_pending` transactions are pending (0 for no limit, see
+        `submit_transaction`).
+
+        The submitted values longer than `value_threshold` (0 for no limit) are
+        stored out of line (see `values.py`), compressed with `compression`.
+
+        The nodes are contacted through the transport (HTTP by default). The
+        heartbeat and mining threads can be disabled (see `simulator.py`):
+        blocks are then only mined by calling `_new_block` and `_publish_block`.
         """
         # Initialize the properties.
         self._master_chain = []
         self._branch_list = []
         self._last_hash = None
         self._pending_transactions = []
-        self._difficulty = 4
+        self._difficulty = difficulty
+        self._block_time = block_time
+        self._retarget_interval = retarget_interval
+        #Last blocks of a chain needed to check the next block (parent and retargeting)
+        self._ancestry = max(1, retarget_interval)
         self._miner = miner
+        self._block_size = block_size
+        self._profiler = profiler
+        self._block_relay = block_relay
+        self._sync_mode = sync_mode
+        self._sync_range = sync_range
+        self._validation_processes = validation_processes
+        self._admission = AdmissionControl(rate_limit, rate_burst, max_pending,
+                                            retry_after=block_time)
+        self._values = ValueStore(value_threshold, compression)
+
+        #Snapshots
+        self._snapshot_interval = snapshot_interval
+        self._snapshot_history = snapshot_history
+        self._prune = prune
+        self._snapshot = None #Latest snapshot adopted on the master chain
+        self._snapshot_candidates = {} #Snapshots by hash of their last block
+
+        #Validation checkpoint: length and last hash of the validated master chain
+        self._validated_length = 0
+        self._validated_hash = None
 
         #Block confirmation request
         self._blocks_to_confirm = []
@@ -108,36 +490,39 @@ class Blockchain:
         if unitTests :
             self._add_genesis_block()
        
-        self.broadcast = Broadcast(set(), self._ip)
+        self._transport = transport if transport is not None else HttpTransport()
+        self.broadcast = Broadcast(set(), self._ip, broadcast_mode,
+                                    self._transport, heartbeat)
 
         #Creating mining thread
-        if self._miner:
-            print("Create mining thread")
+        if self._miner and mining_thread:
+            logger.info("Create mining thread")
             mining_thread = threading.Thread(target = self.mine,daemon=True)
             mining_thread.start()
 
     def _add_genesis_block(self):
         """Adds the genesis block to your blockchain.
         """
-        self._master_chain.append(Block(0, [], time.time(), "0"))
+        self._master_chain.append(Block(0, [], time.time(), "0",
+                                        target=difficulty_to_target(self._difficulty)))
         self._last_hash = self._master_chain[-1].compute_hash()
-        print("Genesis block added, hash :",self._last_hash)
+        logger.info("Genesis block added, hash : %s", self._last_hash)
     
     def bootstrap(self, address):
         """The bootstrap address serves as the initial entry point of
         the bootstrapping procedure. It will contact the specified
         address, download the peerlist, and start the bootstrapping procedure.
         """
-        print("BOOSTRAPING -------------")
+        logger.info("Bootstrapping from %s", address)
         if(address == self._get_ip()):
             # Initialize the chain with the Genesis block.
             self._add_genesis_block()
             return
         # Get the list of peer from bootstrap node
         try:
-            result = send_to_one(address, "peers")
+            result = self._transport.send(address, "peers")
         except exceptions.RequestException:
-            print("Unable to bootstrap (connection failed to bootstrap node)")
+            logger.error("Unable to bootstrap (connection failed to bootstrap node)")
             return
         peers = result.json()["peers"]
         for peer in peers:
@@ -146,40 +531,195 @@ class Blockchain:
         if(self._get_ip() in peers):
             peers.remove(self._get_ip())
 
-        # Get all the blocks from a non-corrupted node
-        hashes = {}
-        for peer in self.get_peers():
-            hashes[peer] = send_to_one(peer, "addNode", {"address" : self._get_ip()})
+        # Get all the blocks from non-corrupted nodes (the majority last hash)
+        hashes = self._get_last_hashes(sorted(self.get_peers()))
+        init_chain = None
         if hashes:
             address = get_address_best_hash(hashes)
-        result = send_to_one(address, "blockchain")
-        chain = result.json()["chain"]
+            if self._sync_mode == "parallel":
+                best_hash = hashes[address]
+                init_chain, snapshot = self._parallel_sync(
+                    [peer for peer in hashes if hashes[peer] == best_hash], best_hash)
+        if init_chain is None:
+            try:
+                init_chain, snapshot = self._download_chain(address)
+            except (exceptions.RequestException, ValueError, KeyError):
+                logger.error("Unable to bootstrap (chain download failed from %s)", address)
+                return
 
-        # Reconstruct the chain
-        init_chain = []
-        for block in chain:
-            block = json.loads(block)
-            transaction = []
+        valid, last_hash = self._validate_received_chain(init_chain, snapshot)
+        if not valid:
+            logger.error("Unable to bootstrap (invalid chain received from %s)", address)
+            return
 
-            for t in block["_transactions"]:
-                transaction.append(Transaction(t["key"], t["value"], t["origin"]))
-            
-            new_block = Block(block["_index"], 
-                                transaction, 
-                                block["_timestamp"], 
-                                block["_previous_hash"],
-                                block["_nonce"])
-            
-            print("Bootstrap BLOCK:",new_block.compute_hash())
-            init_chain.append(new_block)
-        
-        self._master_chain = init_chain
-        self._last_hash = init_chain[-1].compute_hash()
+        self._set_chain(init_chain, last_hash, snapshot)
 
-        print("Bootstrap complete. Blockchain is now {} blocks long".format(len(self._master_chain)))
-        # [print(block.__dict__) for block in self._master_chain]
+        logger.info("Bootstrap complete. Blockchain is now %d blocks long", len(self._master_chain))
         return
    
+    def _get_last_hashes(self, peers):
+        """
+        Announces the node to the peers (concurrently) and returns
+        the hash of the last block of each peer that answered.
+        """
+        def last_hash(peer):
+            try:
+                return self._transport.send(peer, "addNode", {"address" : self._get_ip()}).json()
+            except (exceptions.RequestException, ValueError):
+                logger.warning("Unable to add the node to peer %s", peer)
+                return None
+
+        if not peers:
+            return {}
+        with ThreadPoolExecutor(len(peers)) as executor:
+            hashes = dict(zip(peers, executor.map(last_hash, peers)))
+        return {peer: hashes[peer] for peer in peers if hashes[peer] is not None}
+
+    def _download_chain(self, address):
+        """
+        Downloads the whole chain from one node.
+
+        Returns:
+        ----------
+        - a tuple with the chain and the snapshot it starts from
+            if the node pruned its chain (fast join), None otherwise
+        """
+        result = self._transport.send(address, "blockchain").json()
+        chain = [Block.from_dict(json.loads(block)) for block in result["chain"]]
+        snapshot = None
+        if result.get("snapshot") is not None:
+            snapshot = Snapshot.from_dict(result["snapshot"])
+        return chain, snapshot
+
+    def _parallel_sync(self, peers, best_hash):
+        """
+        Downloads the chain ending with the block `best_hash` from the peers.
+
+        The headers of the chain are fetched (from the first peer sending
+        a valid header chain), then the blocks are downloaded by ranges
+        concurrently from all the peers, each block being checked against
+        its header. A range is retried on the other peers, a peer that
+        failed is not asked again.
+
+        Returns:
+        ----------
+        - a tuple with the chain and its snapshot (see `_download_chain`),
+            (None, None) if it could not be downloaded
+        """
+        headers = None
+        for peer in peers:
+            try:
+                result = self._transport.send(peer, "headers").json()
+                if _valid_headers(result["headers"], best_hash, result.get("snapshot")):
+                    headers = result["headers"]
+                    break
+            except (exceptions.RequestException, ValueError, KeyError):
+                pass
+            logger.warning("Unable to get the headers of the chain from %s", peer)
+        if headers is None:
+            return None, None
+        snapshot = None
+        if result.get("snapshot") is not None:
+            snapshot = Snapshot.from_dict(result["snapshot"])
+
+        first = headers[0]["_index"]
+        end = first + len(headers)
+        ranges = [(start, min(start + self._sync_range, end))
+                  for start in range(first, end, self._sync_range)]
+        failed = set()
+
+        def download(k):
+            #The ranges are spread over the peers
+            start, end = ranges[k]
+            for i in range(len(peers)):
+                peer = peers[(k + i) % len(peers)]
+                if peer in failed:
+                    continue
+                blocks = self._download_range(peer, start, end,
+                                                headers[start - first:end - first])
+                if blocks is not None:
+                    metrics.SYNC_RANGES.inc(outcome="downloaded")
+                    return blocks
+                metrics.SYNC_RANGES.inc(outcome="failed")
+                failed.add(peer)
+            return None
+
+        with ThreadPoolExecutor(min(len(peers), len(ranges))) as executor:
+            ranges_blocks = list(executor.map(download, range(len(ranges))))
+        if any(blocks is None for blocks in ranges_blocks):
+            logger.warning("Parallel sync failed, downloading the chain from one peer")
+            return None, None
+        logger.info("Downloaded %d blocks from %d peers", len(headers), len(peers) - len(failed))
+        return [block for blocks in ranges_blocks for block in blocks], snapshot
+
+    def _download_range(self, peer, start, end, headers):
+        """
+        Downloads the blocks of index `start` to `end` (excluded) from a peer.
+        Returns None if the peer did not send the blocks of the headers.
+        """
+        try:
+            result = self._transport.send(peer, "blocks", {"start": start, "end": end}).json()
+            blocks = [Block.from_dict(json.loads(block)) for block in result["chain"]]
+        except (exceptions.RequestException, ValueError, KeyError):
+            logger.warning("Unable to download blocks %d to %d from %s", start, end, peer)
+            return None
+        if (len(blocks) != len(headers) or
+            any(block.compute_hash() != header["_hash"]
+                for block, header in zip(blocks, headers))):
+            logger.warning("Invalid blocks %d to %d received from %s", start, end, peer)
+            return None
+        return blocks
+
+    def _set_chain(self, chain, last_hash, snapshot = None):
+        """
+        Replaces the master chain by a validated chain (starting
+        from the snapshot if it was pruned).
+        """
+        self._snapshot = snapshot
+        self._master_chain = chain
+        self._last_hash = last_hash
+        self._validated_length = len(chain)
+        self._validated_hash = last_hash
+
+    def _validate_received_chain(self, chain, snapshot = None):
+        """
+        Validates a chain received from another node. A chain coming with
+        a snapshot may have been pruned (it does not start with the genesis
+        block): its first block is then trusted. In any case, the snapshot
+        must match the hash anchored in the chain.
+
+        Returns:
+        ----------
+        - a tuple with a boolean telling if the chain is valid and
+            the hash of its last block
+        """
+        if chain and chain[0]._index == 0:
+            valid, last_hash = validate_chain(chain, processes=self._validation_processes,
+                                retarget_interval=self._retarget_interval,
+                                block_time=self._block_time,
+                                genesis_target=difficulty_to_target(self._difficulty))
+        elif chain and snapshot is not None and chain[0].proof():
+            valid, last_hash = validate_chain(chain[1:], chain[0].compute_hash(),
+                                processes=self._validation_processes,
+                                retarget_interval=self._retarget_interval,
+                                block_time=self._block_time,
+                                ancestors=chain[:1],
+                                genesis_target=difficulty_to_target(self._difficulty))
+        else:
+            return (False, None)
+        if not valid:
+            return (False, None)
+        if snapshot is None:
+            return (True, last_hash)
+
+        # The snapshot is anchored by the block following its last block
+        position = snapshot._index - chain[0]._index
+        if (position < 0 or position + 1 >= len(chain) or
+            chain[position].compute_hash() != snapshot._block_hash or
+            chain[position + 1]._snapshot != snapshot.compute_hash()):
+            return (False, None)
+        return (True, last_hash)
+
     def add_node(self, peer):
         """
         Add a node to the network.
@@ -192,107 +732,317 @@ class Blockchain:
         """
         return self._ip
 
+    def _find_parent(self, previous_hash):
+        """
+        Returns the last blocks (the parent and the retargeting window, if available)
+        of the chain ending with the block whose hash is `previous_hash`,
+        together with the branch and the position of that block in the branch
+        (None, None for the last block of the master chain).
+        Returns None if the block is unknown.
+        """
+        master_tail = self._master_chain[-self._ancestry:]
+        if previous_hash == self._master_chain[-1].compute_hash():
+            return master_tail, None, None
+
+        for branch in self._branch_list:
+            for k in range(len(branch) - 1, -1, -1):
+                if branch[k].compute_hash() == previous_hash:
+                    return master_tail + branch[:k+1], branch, k
+        return None
+
+    def _snapshot_after(self, block_hash):
+        """
+        Returns the snapshot of the state after the block `block_hash`
+        (None if the block is unknown).
+        """
+        if block_hash in self._snapshot_candidates:
+            return self._snapshot_candidates[block_hash]
+        parent = self._find_parent(block_hash)
+        if parent is None:
+            return None
+        _, branch, k = parent
+
+        base = self._snapshot
+        if base is None:
+            base = Snapshot.empty(self._snapshot_history)
+        # Blocks of the master chain are contiguous in index
+        first = base._index + 1 - self._master_chain[0]._index
+        blocks = self._master_chain[first:]
+        if branch is not None:
+            blocks = blocks + branch[:k+1]
+
+        snapshot = base.apply(blocks)
+        self._snapshot_candidates[block_hash] = snapshot
+        return snapshot
+
+    def _expected_snapshot(self, index, previous_hash):
+        """
+        Returns the snapshot hash that the block `index` following the block
+        `previous_hash` must anchor (None if it must not anchor any).
+        """
+        if not self._snapshot_interval or index % self._snapshot_interval != 0:
+            return None
+        return self._snapshot_after(previous_hash).compute_hash()
+
+    def _adopt_snapshots(self, blocks):
+        """
+        Adopts the snapshots anchored by blocks added to the master chain
+        and prunes the master chain behind them if required.
+        """
+        adopted = False
+        for block in blocks:
+            if block._snapshot is not None:
+                self._snapshot = self._snapshot_candidates[block._previous_hash]
+                adopted = True
+        if self._snapshot is None:
+            return
+        if adopted:
+            #The messages of the blocks behind the snapshot will not come back
+            self.broadcast.rotate()
+        # Snapshots of blocks now behind the master chain are useless
+        self._snapshot_candidates = {block_hash: snapshot for block_hash, snapshot
+                                    in self._snapshot_candidates.items()
+                                    if snapshot._index > self._snapshot._index}
+
+        if self._prune:
+            #Keep the blocks needed to link to the snapshot and to retarget
+            first_index = self._snapshot._index - self._ancestry + 1
+            dropped = first_index - self._master_chain[0]._index
+            if dropped > 0:
+                del self._master_chain[:dropped]
+                self._validated_length = max(1, self._validated_length - dropped)
+                self._validated_hash = self._master_chain[self._validated_length - 1].compute_hash()
+                logger.info("Pruned %d blocks behind snapshot %d", dropped,
+                        self._snapshot._index)
+                self._collect_values()
+
+    def _collect_values(self):
+        """
+        Drops the stored values that are no longer referenced by the
+        snapshot, the blocks of the chain, the branches, the pool or the
+        block being mined.
+        """
+        values = self._snapshot.values()
+        for block in self._master_chain:
+            values.extend(t.value for t in block.get_transactions())
+        for branch in self._branch_list:
+            for block in branch:
+                values.extend(t.value for t in block.get_transactions())
+        values.extend(t.value for t in list(self._pending_transactions))
+        block_to_mine = self._block_to_mine
+        if block_to_mine is not None:
+            values.extend(t.value for t in block_to_mine.get_transactions())
+        referenced = {value[REFERENCE] for value in values if is_reference(value)}
+        dropped = self._values.collect(referenced)
+        if dropped:
+            logger.info("Dropped %d values no longer referenced", dropped)
+
+    def get_snapshot(self):
+        """Returns the latest snapshot adopted on the master chain, or None.
+        """
+        return self._snapshot
+
     def _add_block(self,new_block):
         """
         Add a block to the blockchain if it is valid
-        Apply longest chain rule
+        Apply longest chain rule, the length of a branch being its
+        cumulative work
         Constraint: Discard block if the parent is more than 1 generation away
         from the master chain
         """
+        parent = self._find_parent(new_block._previous_hash)
+        if parent is None:
+            logger.warning("Block has an unknown parent")
+            metrics.REJECTED_BLOCKS.inc(reason="parent")
+            return False
+        ancestry, branch, k = parent
 
         #Check block validity
-        if not new_block.proof(self._difficulty):
-            print("Block has incorrect proof")
+        expected_target = next_target(ancestry, self._retarget_interval, self._block_time,
+                                      difficulty_to_target(self._difficulty))
+        if (new_block._index != ancestry[-1]._index + 1 or
+            new_block._target != expected_target):
+            logger.warning("Block has incorrect index or target")
+            metrics.REJECTED_BLOCKS.inc(reason="target")
+            return False
+
+        if new_block._snapshot != self._expected_snapshot(new_block._index,
+                                                        new_block._previous_hash):
+            logger.warning("Block has incorrect snapshot")
+            metrics.REJECTED_BLOCKS.inc(reason="snapshot")
             return False
 
         new_block_hash = new_block.compute_hash()
+        if not check_proof(new_block_hash, new_block._target):
+            logger.warning("Block has incorrect proof")
+            metrics.REJECTED_BLOCKS.inc(reason="proof")
+            return False
 
-        #Direct successors of last block from master node
-        #Discard block if the parent is more than 1 generation away
-        if new_block._previous_hash == self._master_chain[-1].compute_hash():
+        if branch is None:
+            #Direct successors of last block from master node
             self._branch_list.append([new_block])
-            print("Block ID {} hash {} added to BRANCH".format(new_block._index, 
-                            new_block_hash))
-            return True
-
-        createBranch = False
-        for branch in self._branch_list:
-            if createBranch:
-                break
+            if len(self._branch_list) > 1:
+                metrics.FORKS.inc()
+            logger.debug("Block ID %d hash %s added to BRANCH", new_block._index,
+                            new_block_hash)
+        elif k == len(branch) - 1:
             #If parent of new_block is last block of the branch,
             #add it to the branch
-            if branch[-1].compute_hash() == new_block._previous_hash:
-                branch.append(new_block)
-                createBranch = True
-                print("Block ID {} hash {} added to BRANCH".format(new_block._index, 
-                                new_block_hash))
-                break
+            branch.append(new_block)
+            logger.debug("Block ID %d hash %s added to BRANCH", new_block._index,
+                            new_block_hash)
+        else:
             #Else, copy the branch and add the new block to the copy
-            for k, block in enumerate(branch):
-                if new_block._previous_hash == block.compute_hash():
-                    new_branch = copy.deepcopy(branch[:k+1])
-                    new_branch.append(new_block)
-                    self._branch_list.append(new_branch)
-                    print("Block ID {} hash {} added to NEW BRANCH".format(new_block._index, 
-                                new_block_hash))
-                    createBranch = True
-                    break
+            new_branch = branch[:k+1]
+            new_branch.append(new_block)
+            self._branch_list.append(new_branch)
+            metrics.FORKS.inc()
+            logger.debug("Block ID %d hash %s added to NEW BRANCH", new_block._index,
+                            new_block_hash)
 
-        max_len_branch = sorted(self._branch_list, key=len)[-1]
-        max_len = len(sorted(self._branch_list, key=len)[-1])
-        
-        #Longest chain rule : part of branch longer or equal to 2 blocks get added
-        if max_len >= 2:
-            #Add all but one element to the master chain
+        #Mine on top of the branch with the most cumulative work
+        best_branch = max(self._branch_list,
+                            key=lambda branch: sum(block_work(b._target) for b in branch))
+        self._last_hash = best_branch[-1].compute_hash()
 
-            self._last_hash = max_len_branch[-1].compute_hash()
-            self._master_chain.extend(max_len_branch[:-1])
+        #Longest chain rule : part of the heaviest branch longer or equal
+        #to 2 blocks get added
+        if len(best_branch) >= 2:
+            #Add all but one element to the master chain
+            self._master_chain.extend(best_branch[:-1])
             #Remove all  but one element from the list of branches
-            self._branch_list = [[max_len_branch[-1]]]
-            for block in max_len_branch[:-1]:
-                print("Block ID {} hash {} added to MASTER".format(block._index, 
-                        block.compute_hash()))
+            self._branch_list = [[best_branch[-1]]]
+            now = time.time()
+            for block in best_branch[:-1]:
+                metrics.BLOCK_COMMIT_LATENCY.observe(now - block._timestamp)
+                logger.info("Block ID %d hash %s added to MASTER", block._index,
+                        block.compute_hash())
+            self._adopt_snapshots(best_branch[:-1])
+
+        return True
 
-            return True
-        
-        return createBranch
-    
     def _proof_of_work(self):
         """
         Implement the proof of work algorithm
         Also check for block confirmation request from another Node
         """
         #Reset nonce
-        self._block_to_mine._nonce = 0
+        self._block_to_mine._set_nonce(0)
 
         #Get the real hash of the block
         computed_hash = self._block_to_mine.compute_hash()
 
         #Find the nonce that computes the right block hash
-        while not computed_hash.startswith('0' * self._difficulty):
+        #(the hashes are counted locally, the metrics are updated once)
+        target = self._block_to_mine._target
+        attempts = 1
+        start = time.time()
+        while int(computed_hash, 16) > target:
             
             if not self._confirm_block:
                 self._block_to_mine._change_nonce()
                 computed_hash = self._block_to_mine.compute_hash()
+                attempts += 1
             
             if self._block_added:
                 self._block_added = False
+                self._record_pow(attempts, start)
                 #Discard currently mined block
                 return False
 
-        #Broadcast block to other nodes
-        self.broadcast.broadcast("block",json.dumps(self._block_to_mine.__dict__,
-                                                        sort_keys=True,
-                                                        cls=TransactionEncoder))
-        print("Mined block hash",computed_hash)
-        self._last_hash = computed_hash
+        self._record_pow(attempts, start)
+        metrics.POW_ATTEMPTS.observe(attempts)
         return True
 
+    def _publish_block(self, block):
+        """
+        Adds a mined block to the chain and broadcasts it to the other nodes.
+        The block is added first, so that the peers rebuilding it from its
+        compact form can fetch its transactions from this node at once.
+        """
+        metrics.BLOCKS_MINED.inc()
+        logger.info("Mined block hash %s", block.compute_hash())
+        self._last_hash = block.compute_hash()
+        if not self._add_block(block):
+            return
+        if self._block_relay == "compact":
+            self.broadcast.broadcast("compact_block",json.dumps(block.to_compact_dict(),
+                                                                sort_keys=True))
+        else:
+            self.broadcast.broadcast("block",json.dumps(block.to_dict(),
+                                                            sort_keys=True,
+                                                            cls=TransactionEncoder))
+
+    def _record_pow(self, attempts, start):
+        """
+        Updates the hashing metrics after a proof of work.
+        """
+        metrics.HASHES.inc(attempts)
+        elapsed = time.time() - start
+        if elapsed > 0:
+            metrics.HASH_RATE.set(attempts / elapsed)
+
     def get_blocks(self):
         """ Returns all blocks from the chain.
         """
         return self._master_chain
 
+    def get_pending_transactions(self):
+        """ Returns the transactions waiting to be mined.
+        """
+        return self._pending_transactions
+
+    def get_branches(self):
+        """ Returns the branches waiting to be added to the master chain.
+        """
+        return self._branch_list
+
+    def get_headers(self):
+        """Returns the headers (see `Block.to_header_dict`) of the master chain.
+        """
+        return [block.to_header_dict() for block in self._master_chain]
+
+    def get_block_range(self, start, end = None):
+        """Returns the blocks of the master chain of index `start` to `end`
+        (excluded, the end of the chain if None), None if some of them are
+        not in the chain.
+        """
+        chain = self._master_chain
+        first = chain[0]._index
+        if end is None:
+            end = first + len(chain)
+        if start < first or end > first + len(chain) or start >= end:
+            return None
+        return chain[start - first:end - first]
+
+    def chain_payload(self):
+        """Returns the answer of the `/blockchain` route: the master chain
+        (blocks in JSON), its length and the snapshot it starts from.
+        """
+        snapshot = self._snapshot
+        chain = [json.dumps(block.to_dict(), sort_keys=True, cls=TransactionEncoder)
+                 for block in self._master_chain]
+        return {"length": len(chain), "chain": chain,
+                "snapshot": snapshot.to_dict() if snapshot is not None else None}
+
+    def headers_payload(self):
+        """Returns the answer of the `/headers` route: the headers of the
+        master chain and the snapshot it starts from.
+        """
+        snapshot = self._snapshot
+        return {"headers": self.get_headers(),
+                "snapshot": snapshot.to_dict() if snapshot is not None else None}
+
+    def block_range_payload(self, start, end = None):
+        """Returns the answer of the `/blocks` route (see `get_block_range`),
+        None if some of the blocks are not in the chain.
+        """
+        blocks = self.get_block_range(start, end)
+        if blocks is None:
+            return None
+        return {"chain": [json.dumps(block.to_dict(), sort_keys=True,
+                                     cls=TransactionEncoder) for block in blocks]}
+
     def get_last_master_hash(self):
         """Returns the hash of the last block.
         """
@@ -315,12 +1065,208 @@ class Blockchain:
         NB : If the `mine` method is called, it will collect the current list
         of transactions, and attempt to mine a block with those.
         """
-        # print("Added transaction" ,transaction.__dict__)
         self._pending_transactions.append(transaction)
         if broadcast:
-            self.broadcast.broadcast("transaction",json.dumps(transaction.__dict__,sort_keys=True))
+            self.broadcast.broadcast("transaction",json.dumps(transaction.to_dict(),sort_keys=True))
         return
 
+    def submit_transaction(self, transaction, client = None):
+        """Adds a transaction submitted by a client, if the admission control
+        accepts it (the transactions broadcast by the peers are not limited).
+
+        Arguments:
+        ----------
+        - `transaction`: the transaction submitted
+        - `client`: address the client connects from, whose rate is limited
+                        (the origin of the transaction if None)
+
+        Returns:
+        ----------
+        - None if the transaction was added, otherwise the number of
+            seconds after which the client should retry
+        """
+        if client is None:
+            client = transaction.origin
+        refusal = self._admission.admit(client, len(self._pending_transactions))
+        if refusal is not None:
+            reason, retry_after = refusal
+            metrics.REFUSED_TRANSACTIONS.inc(reason=reason)
+            logger.debug("Transaction from %s refused (%s)", client, reason)
+            return retry_after
+
+        value = self._values.externalize(transaction.value)
+        if value is not transaction.value:
+            #The value is pushed to the peers before the transaction referencing it
+            encoding, data = self._values.get(value[REFERENCE])
+            self.broadcast.broadcast("value", json.dumps({"hash": value[REFERENCE],
+                                                            "encoding": encoding,
+                                                            "data": data}))
+            transaction = Transaction(transaction.key, value, transaction.origin)
+        self.add_transaction(transaction)
+        return None
+
+    def deliver(self, message_type, message, sender):
+        """Handles a message received through the broadcast.
+
+        Arguments:
+        ----------
+        - `message_type`: type of message {transaction, block, compact_block, value}
+        - `message`: the message (JSON)
+        - `sender`: address of the node that broadcast the message
+        """
+        delivered, _ = self.broadcast.deliver(message_type, message, sender)
+        if not delivered:
+            return
+
+        if message_type == "transaction":
+            t = json.loads(message)
+            self.add_transaction(Transaction(t["key"], t["value"], t["origin"]), False)
+        elif message_type == "block":
+            self.confirm_block(Block.from_dict(json.loads(message)))
+        elif message_type == "compact_block":
+            block = self._rebuild_block(json.loads(message), sender)
+            if block is not None:
+                self.confirm_block(block)
+        elif message_type == "value":
+            v = json.loads(message)
+            if not self._values.put(v["hash"], v["encoding"], v["data"]):
+                logger.warning("Value received from %s does not match its hash", sender)
+
+    def get_value(self, value_hash):
+        """Returns the encoding and the encoded JSON of a value stored out
+        of line, None if it is unknown.
+        """
+        return self._values.get(value_hash)
+
+    def value_payload(self, value_hash):
+        """Returns the answer of the `/value` route (see `get_value`),
+        None if the value is unknown.
+        """
+        value = self.get_value(value_hash)
+        if value is None:
+            return None
+        return {"encoding": value[0], "data": value[1]}
+
+    def _resolve(self, value):
+        """Returns the original value of a transaction value. A value stored
+        out of line that is unknown (the node missed its broadcast) is fetched
+        from the peers, None is returned if none of them has it.
+        """
+        try:
+            return self._values.resolve(value)
+        except KeyError:
+            pass
+        value_hash = value[REFERENCE]
+        for peer in sorted(self.get_peers()):
+            try:
+                result = self._transport.send(peer, "value", {"hash": value_hash}).json()
+                if self._values.put(value_hash, result["encoding"], result["data"]):
+                    metrics.VALUE_FETCHES.inc(outcome="fetched")
+                    return self._values.resolve(value)
+            except (exceptions.RequestException, ValueError, KeyError):
+                logger.debug("Unable to fetch value %s from %s", value_hash, peer)
+        metrics.VALUE_FETCHES.inc(outcome="failed")
+        logger.warning("Unable to fetch value %s", value_hash)
+        return None
+
+    def _rebuild_block(self, compact, sender):
+        """Rebuilds a compact block with the transactions of the pool
+        (and of the block being mined and of the branches). The missing transactions are
+        fetched from the sender, or from the other peers if it does
+        not answer. If a short id matched the wrong transaction, all the
+        transactions are fetched.
+
+        Returns the block, or None if it could not be rebuilt.
+        """
+        known = {}
+        pool = list(self._pending_transactions)
+        block_to_mine = self._block_to_mine
+        if block_to_mine is not None:
+            pool.extend(block_to_mine.get_transactions())
+        for branch in self._branch_list:
+            for block in branch:
+                pool.extend(block.get_transactions())
+        for transaction in pool:
+            known[transaction.get_id()[:SHORT_ID_LENGTH]] = transaction
+
+        short_ids = compact["_short_ids"]
+        transactions = [known.get(short_id) for short_id in short_ids]
+        missing = [i for i, transaction in enumerate(transactions) if transaction is None]
+        if missing:
+            fetched = self._fetch_transactions(compact["_hash"], missing, sender)
+            if fetched is None:
+                metrics.COMPACT_BLOCKS.inc(outcome="failed")
+                return None
+            for i, transaction in zip(missing, fetched):
+                transactions[i] = transaction
+
+        block = Block.from_compact_dict(compact, transactions)
+        if block.compute_hash() != compact["_hash"]:
+            #Short id collision
+            fetched = self._fetch_transactions(compact["_hash"], range(len(short_ids)), sender)
+            if fetched is None:
+                metrics.COMPACT_BLOCKS.inc(outcome="failed")
+                return None
+            block = Block.from_compact_dict(compact, fetched)
+            if block.compute_hash() != compact["_hash"]:
+                logger.warning("Compact block %s does not match its transactions",
+                                compact["_hash"])
+                metrics.COMPACT_BLOCKS.inc(outcome="failed")
+                return None
+            missing = short_ids
+        metrics.COMPACT_BLOCKS.inc(outcome="fetched" if missing else "rebuilt")
+        metrics.COMPACT_BLOCK_MISSING.inc(len(missing))
+        return block
+
+    def _fetch_transactions(self, block_hash, indexes, sender):
+        """Returns the transactions at `indexes` in the block, asked to
+        the sender first and then to the other peers (None if no node
+        answered with one transaction per index).
+        """
+        indexes = list(indexes)
+        parameters = {"hash": block_hash, "indexes": ",".join(str(i) for i in indexes)}
+        peers = [sender] + [peer for peer in sorted(self.get_peers()) if peer != sender]
+        for peer in peers:
+            try:
+                result = self._transport.send(peer, "blockTransactions", parameters)
+                transactions = [Transaction(t["key"], t["value"], t["origin"])
+                                for t in result.json()["transactions"]]
+            except (exceptions.RequestException, ValueError, KeyError, TypeError):
+                logger.debug("Unable to fetch the transactions of block %s from %s",
+                                block_hash, peer)
+                continue
+            if len(transactions) == len(indexes):
+                return transactions
+            logger.debug("%s answered %d transactions of block %s instead of %d",
+                            peer, len(transactions), block_hash, len(indexes))
+        logger.warning("Unable to rebuild compact block %s", block_hash)
+        return None
+
+    def get_block_transactions(self, block_hash, indexes):
+        """Returns the transactions at `indexes` in a recent block
+        (on a branch or at the end of the master chain),
+        None if the block is unknown.
+        """
+        blocks = list(self._master_chain[-COMPACT_BLOCK_DEPTH:])
+        for branch in self._branch_list:
+            blocks.extend(branch)
+        for block in blocks:
+            if block.compute_hash() == block_hash:
+                transactions = block.get_transactions()
+                if any(i < 0 or i >= len(transactions) for i in indexes):
+                    return None
+                return [transactions[i] for i in indexes]
+        return None
+
+    def block_transactions_payload(self, block_hash, indexes):
+        """Returns the answer of the `/blockTransactions` route (see
+        `get_block_transactions`), None if the block is unknown.
+        """
+        transactions = self.get_block_transactions(block_hash, indexes)
+        if transactions is None:
+            return None
+        return {"transactions": [t.to_dict() for t in transactions]}
+
     def confirm_block(self,foreign_block):
         """Pass a block to be confirmed by the blockchain.
 
@@ -333,19 +1279,20 @@ class Blockchain:
         if self._miner :
             self._confirm_block = True
 
-            print("Confirming an incoming block with hash ",
+            logger.debug("Confirming an incoming block with hash %s",
                     foreign_block.compute_hash())
 
             if self._add_block(foreign_block):
                 self._block_added = True
-                print("Block confirmed by other node")      
+                logger.debug("Block confirmed by other node")
 
-                local_block_tr = self._block_to_mine.get_transactions()
+                local_block_tr = []
+                if self._block_to_mine is not None:
+                    local_block_tr = list(self._block_to_mine.get_transactions())
 
                 for tr in foreign_block.get_transactions():
                     # Remove the incoming block's transaction from the pool
                     if tr in self._pending_transactions:
-                        print(tr.key, tr.value)
                         self._pending_transactions.remove(tr)
 
                         
@@ -362,11 +1309,9 @@ class Blockchain:
                 return True
             else:
                 #Block is not valid, we continue mining
-                # print("Resume mining...")
                 #Reset block confirmation fields
                 self._confirm_block = False
                 return False
-            print("Block confirmed by other node")      
         else:
             self._pending_transactions = []
             return self._add_block(foreign_block)
@@ -377,42 +1322,219 @@ class Blockchain:
         while(True):
             if not self._pending_transactions:
                 time.sleep(1) #Wait before checking new transactions
+            elif self._profiler is not None:
+                with self._profiler.profile("miner"):
+                    self._mine_block()
             else:
-                input_tr = copy.deepcopy(self._pending_transactions)
-                nb_transactions = len(input_tr)
-                self._block_to_mine = Block(index=random.randint(1, sys.maxsize),
-                                transactions=input_tr,
-                                timestamp=time.time(),
-                                previous_hash=self._last_hash)
+                self._mine_block()
+
+    def _mine_block(self):
+        """Mines a block with the pending transactions.
+        """
+        self._block_to_mine = self._new_block()
+        if self._proof_of_work(): 
+            self._publish_block(self._block_to_mine)
+            #The mined block is in the chain, its transactions
+            #must not be put back in the pool
+            self._block_to_mine = None
 
-                #Remove the transactions that were inserted into the block
-                del self._pending_transactions[:nb_transactions]
+    def _new_block(self, timestamp = None):
+        """Returns a block (to be mined) with the pending transactions,
+        on top of the branch with the most work. The transactions are
+        removed from the pool.
+        """
+        input_tr = list(self._pending_transactions)
+        if self._block_size:
+            input_tr = input_tr[:self._block_size]
+        nb_transactions = len(input_tr)
+        parent = self._find_parent(self._last_hash)
+        if parent is None:
+            parent = self._find_parent(self._master_chain[-1].compute_hash())
+        ancestry = parent[0]
+        index = ancestry[-1]._index + 1
+        previous_hash = ancestry[-1].compute_hash()
+        block = Block(index=index,
+                        transactions=input_tr,
+                        timestamp=time.time() if timestamp is None else timestamp,
+                        previous_hash=previous_hash,
+                        target=next_target(ancestry,
+                                            self._retarget_interval,
+                                            self._block_time,
+                                            difficulty_to_target(self._difficulty)),
+                        snapshot=self._expected_snapshot(index, previous_hash))
 
-                # print("Processed {} transaction(s) in this block, {} pending".format(nb_transactions, len(self._pending_transactions)))
+        #Remove the transactions that were inserted into the block
+        del self._pending_transactions[:nb_transactions]
+        return block
 
-                if self._proof_of_work(): 
-                    self._add_block(self._block_to_mine)
+    def is_ready(self):
+        """Returns True once the node has been bootstrapped.
+        """
+        return len(self._master_chain) > 0
+
+    def retrieve(self, key):
+        """Returns the most recent value of the key on the master chain,
+        or None if the key is unknown.
+        """
+        for block in reversed(self._master_chain):
+            for transaction in reversed(block.get_transactions()):
+                if key == transaction.key:
+                    return self._resolve(transaction.value)
+        # The blocks dropped from a pruned chain are only known by the snapshot
+        if self._snapshot is not None and self._master_chain[0]._index > 0:
+            return self._resolve(self._snapshot.retrieve(key))
+        return None
+
+    def retrieve_all(self, key):
+        """Returns all the values of the key on the master chain,
+        from the most recent to the oldest. Behind a pruned chain whose
+        snapshot has no history, only the latest value of the key is known.
+        """
+        values = []
+        overlap = 0 #Values of the blocks kept in the chain and in the snapshot
+        snapshot = self._snapshot
+        for block in reversed(self._master_chain):
+            for transaction in reversed(block.get_transactions()):
+                if key == transaction.key:
+                    values.append(transaction.value)
+                    if snapshot is not None and block._index <= snapshot._index:
+                        overlap += 1
+        if snapshot is not None and self._master_chain[0]._index > 0:
+            values.extend(snapshot.retrieve_all(key)[overlap:])
+        return [self._resolve(value) for value in values]
 
     def is_valid(self):
         """Checks if the current state of the blockchain is valid, 
         meaning, are the sequence of hashes, and the proofs of the
         blocks correct?
+
+        Only the blocks added since the last successful validation
+        are checked.
         """
         chain = self._master_chain
-        last_block = chain[-1]
-        previous_hash = last_block._previous_hash
-        print("Previous hash",previous_hash)
-        it = -1
-        while previous_hash != "0":
-            #Check if proof is valid and if previous hashes match
-            if(previous_hash != chain[it-1].compute_hash() or
-                not chain[it].proof(self._difficulty)):
-                
-                return False
-            it = it - 1
-            previous_hash = chain[it]._previous_hash
-        
-        return True
+        start = self._validated_length
+        previous_hash = self._validated_hash if start > 0 else None
+        ancestors = chain[max(0, start - self._ancestry):start]
+        valid, last_hash = validate_chain(chain[start:], previous_hash,
+                                processes=self._validation_processes,
+                                retarget_interval=self._retarget_interval,
+                                block_time=self._block_time,
+                                ancestors=ancestors,
+                                genesis_target=difficulty_to_target(self._difficulty))
+        if valid:
+            self._validated_length = len(chain)
+            self._validated_hash = last_hash
+        return valid
+
+
+def _hash_blocks(blocks):
+    """
+    Returns the hashes of the contents of a list of blocks.
+    """
+    return [block.hash_contents() for block in blocks]
+
+
+def validate_chain(chain, previous_hash = None, processes = None,
+                    chunk_size = 2000, retarget_interval = None,
+                    block_time = None, ancestors = (), genesis_target = None):
+    """
+    Checks the proofs, the hash linkage, the heights and the targets
+    of a sequence of blocks.
+
+    Every block is hashed exactly once, from its contents rather than its
+    cached hash. When a pool is asked for (`processes` >= 2), sequences
+    longer than `chunk_size` are hashed in chunks across processes, the
+    linkage and the proofs being checked afterwards on the hashes. The pool
+    is opt-in (see the `--validation-processes` option of the nodes), and
+    its processes are spawned rather than forked from a node running threads.
+
+    Arguments:
+    ----------
+    - `chain`: list of blocks to check
+    - `previous_hash`: hash of the block preceding the first block
+                        of the sequence, None if it starts with the genesis block
+    - `processes`: number of processes of the pool, None to hash in
+                        this process
+    - `chunk_size`: number of blocks hashed by a process at once
+    - `retarget_interval`, `block_time`: retargeting parameters (see
+                        `next_target`), the targets are not checked if None
+                        and must all be the genesis target if 0
+    - `ancestors`: the last `retarget_interval` blocks preceding the sequence.
+                        The target of a retargeting block is not checked
+                        if they are missing (first retarget of a pruned chain)
+    - `genesis_target`: target of the genesis block, not checked if None,
+                        and largest target of the blocks (see `next_target`)
+
+    Returns:
+    ----------
+    - a tuple with:
+        - a boolean telling if the sequence is valid
+        - the hash of the last block of the sequence (`previous_hash`
+            if the sequence is empty)
+    """
+    if not chain:
+        return (previous_hash is not None, previous_hash)
+
+    if processes is None or processes < 2 or len(chain) <= chunk_size:
+        hashes = _hash_blocks(chain)
+    else:
+        # Spawned workers: forking a process running threads (server,
+        # miner) could leave locks held in the children
+        chunks = [chain[i:i + chunk_size] for i in range(0, len(chain), chunk_size)]
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            hashes = [h for chunk in pool.map(_hash_blocks, chunks) for h in chunk]
+
+    start = 0
+    if previous_hash is None:
+        # The genesis block has no proof
+        if chain[0]._previous_hash != "0" or chain[0]._index != 0:
+            return (False, None)
+        if genesis_target is not None and chain[0]._target != genesis_target:
+            return (False, None)
+        previous_hash = hashes[0]
+        start = 1
+
+    # Last blocks needed to check the heights and the targets
+    window_size = retarget_interval or 1
+    window = (list(ancestors) + chain[:start])[-window_size:]
+    for block, block_hash in zip(chain[start:], hashes[start:]):
+        if (block._previous_hash != previous_hash or
+            not check_proof(block_hash, block._target)):
+            return (False, None)
+        if window:
+            if block._index != window[-1]._index + 1:
+                return (False, None)
+            if (retarget_interval is not None and
+                (not retarget_interval or len(window) >= retarget_interval or
+                 window[0]._index == 0 or block._index % retarget_interval != 0) and
+                block._target != next_target(window, retarget_interval, block_time,
+                                             genesis_target or MAX_TARGET)):
+                return (False, None)
+        window.append(block)
+        if len(window) > window_size:
+            del window[0]
+        previous_hash = block_hash
+
+    return (True, previous_hash)
+
+
+def _valid_headers(headers, last_hash, snapshot = None):
+    """
+    Checks the hash linkage, the heights and the proofs of a chain of
+    headers ending with the block `last_hash`. The chain starts with the
+    genesis block, unless it comes with a snapshot (pruned chain).
+    The targets are checked with the blocks (see `validate_chain`).
+    """
+    if not headers or headers[-1]["_hash"] != last_hash:
+        return False
+    if snapshot is None and (headers[0]["_index"] != 0 or headers[0]["_previous_hash"] != "0"):
+        return False
+    for previous, header in zip(headers, headers[1:]):
+        if (header["_previous_hash"] != previous["_hash"] or
+            header["_index"] != previous["_index"] + 1 or
+            not check_proof(header["_hash"], header["_target"])):
+            return False
+    return True
 
 
 def get_address_best_hash(hashes):
@@ -1,16 +1,19 @@
 import time
 import datetime
 import json
+import math
 import random
 import argparse
 import sys
 import operator
 from hashlib import sha256
-from flask import Flask, request
+from flask import Flask, Response, g, request
 from requests import get, post, exceptions
 import logging
 from blockchain import Block, Blockchain, Transaction, TransactionEncoder
 from threading import Thread
+import metrics
+from profiling import Profiler
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -23,6 +26,66 @@ def parse_arguments():
                         help="Sets the address of the bootstrap node.")
     parser.add_argument("--port", type=int, default=5000,
                         help="Port on which the flask application runs")
+    parser.add_argument("--difficulty", type=int, default=4,
+                        help="Initial difficulty (leading zeros of the hashes)")
+    parser.add_argument("--block-time", type=float, default=10,
+                        help="Targeted time between two blocks in seconds "
+                        "(with --retarget-interval)")
+    parser.add_argument("--retarget-interval", type=int, default=0,
+                        help="Number of blocks between two difficulty adjustments "
+                        "(0 keeps the initial difficulty)")
+    parser.add_argument("--block-size", type=int, default=0,
+                        help="Maximum number of transactions per block (0 for no limit)")
+    parser.add_argument("--broadcast", type=str, default="reliable",
+                        choices=["reliable", "best-effort"],
+                        help="Broadcast algorithm used to spread the messages")
+    parser.add_argument("--block-relay", type=str, default="compact",
+                        choices=["compact", "full"],
+                        help="Announce the mined blocks with the short ids of their "
+                        "transactions (compact) or send them whole (full)")
+    parser.add_argument("--sync", type=str, default="parallel",
+                        choices=["parallel", "single"],
+                        help="Download the chain by ranges from all the peers when "
+                        "bootstrapping (parallel) or from one peer (single)")
+    parser.add_argument("--sync-range", type=int, default=500,
+                        help="Number of blocks of the ranges of the parallel sync")
+    parser.add_argument("--validation-processes", type=int, default=None,
+                        help="Number of processes hashing the chains being validated "
+                        "(by default, they are hashed in the node process)")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="Transactions accepted per second and client address "
+                        "by /put (0 for no limit)")
+    parser.add_argument("--rate-burst", type=int, default=10,
+                        help="Transactions a client can submit at once")
+    parser.add_argument("--max-pending", type=int, default=0,
+                        help="Pending transactions above which /put refuses the "
+                        "transactions (0 for no limit)")
+    parser.add_argument("--value-threshold", type=int, default=0,
+                        help="Size (JSON characters) above which the values are stored "
+                        "out of line, the transactions holding their hash (0 disables it)")
+    parser.add_argument("--compression", type=str, default="none",
+                        choices=["none", "zlib"],
+                        help="Compression of the values stored out of line")
+    parser.add_argument("--snapshot-interval", type=int, default=0,
+                        help="Number of blocks between two state snapshots "
+                        "(0 disables the snapshots)")
+    parser.add_argument("--snapshot-history", type=bool, default=False, nargs='?',
+                        const=True, help="Keep all the values of the keys in the snapshots.")
+    parser.add_argument("--prune", type=bool, default=False, nargs='?',
+                        const=True, help="Drop the blocks behind the latest snapshot.")
+    parser.add_argument("--log-level", type=str, default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging level of the node (DEBUG logs every "
+                        "block and message, at a cost under load)")
+    parser.add_argument("--profile", type=bool, default=False, nargs='?',
+                        const=True, help="Profiles the miner and the request "
+                        "handlers (statistics served by /profile).")
+    parser.add_argument("--server", type=str, default="flask",
+                        choices=["flask", "waitress"],
+                        help="WSGI server used to serve the API. `waitress` "
+                        "is a multi-threaded production server.")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Number of worker threads of the waitress server")
     arguments, _ = parser.parse_known_args()
 
     return arguments
@@ -35,17 +98,83 @@ log = logging.getLogger('werkzeug')
 log.disabled = True
 app.logger.disabled = True
 
-#Instanciate the blockchain
-arguments = parse_arguments()
-node = Blockchain(miner = arguments.miner, port = arguments.port)
+#Blockchain served by the application, see `init_node`
+node = None
+#Profiler of the request handlers (None if not profiling)
+profiler = None
+
+def init_node(blockchain, node_profiler = None):
+    """
+    Set the blockchain node served by the application,
+    and the profiler of the request handlers.
+    """
+    global node, profiler
+    node = blockchain
+    profiler = node_profiler
+    metrics.MEMPOOL_SIZE.set_function(lambda: len(node.get_pending_transactions()))
+    metrics.BRANCHES.set_function(lambda: len(node.get_branches()))
+
+#Routes whose latency is recorded
+TIMED_ROUTES = ("/put", "/retrieve", "/retrieve_all")
+
+@app.before_request
+def start_timer():
+    g.start = time.time()
+    if profiler is not None and request.path != "/profile":
+        g.profile = profiler.start()
+
+@app.after_request
+def record_latency(response):
+    if request.path in TIMED_ROUTES:
+        metrics.REQUEST_LATENCY.observe(time.time() - g.start, path=request.path)
+    if profiler is not None and "profile" in g:
+        profiler.stop("request " + request.path, g.pop("profile"))
+    return response
+
+@app.route("/profile")
+def get_profile():
+    # Statistics of a profiled subsystem, or the list of the subsystems
+    if profiler is None:
+        return Response("Profiling is disabled (start the node with --profile)\n",
+                        status=404, mimetype="text/plain")
+    if request.args.get("reset"):
+        profiler.reset()
+    subsystem = request.args.get("subsystem")
+    if subsystem is None:
+        return json.dumps({"subsystems": profiler.subsystems()})
+    stats = profiler.dump(subsystem, request.args.get("sort", "cumulative"),
+                            int(request.args.get("limit", 40)))
+    if stats is None:
+        return Response("Unknown subsystem\n", status=404, mimetype="text/plain")
+    return Response(stats, mimetype="text/plain")
+
+@app.route("/metrics")
+def get_metrics():
+    # Metrics of the node in the Prometheus text format
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/blockchain")
 def get_chain():
-    chain_data = []
     # Returns the blockchain and its length
-    for block in node.get_blocks():
-        chain_data.append(json.dumps(block.__dict__, sort_keys=True, cls=TransactionEncoder))
-    return json.dumps({"length": len(chain_data), "chain": chain_data})
+    # (a pruned chain starts from the latest snapshot)
+    return json.dumps(node.chain_payload())
+
+
+@app.route("/headers")
+def get_headers():
+    # Headers of the master chain, and the snapshot it starts from
+    return json.dumps(node.headers_payload())
+
+@app.route("/blocks")
+def get_blocks():
+    # Blocks of the master chain of index start to end (excluded, or to the
+    # end of the chain)
+    end = request.args.get("end")
+    payload = node.block_range_payload(int(request.args.get("start")),
+                                        int(end) if end is not None else None)
+    if payload is None:
+        return Response("Blocks not in the chain\n", status=404, mimetype="text/plain")
+    return json.dumps(payload)
 
 
 @app.route("/addNode")
@@ -57,6 +186,23 @@ def add_node():
     node.add_node(address)
     return json.dumps(node.get_last_master_hash())
     
+@app.route("/blockTransactions")
+def get_block_transactions():
+    # Transactions of a recent block, by position (compact block relay)
+    indexes = [int(i) for i in request.args.get("indexes", "").split(",") if i]
+    payload = node.block_transactions_payload(request.args.get("hash"), indexes)
+    if payload is None:
+        return Response("Unknown block\n", status=404, mimetype="text/plain")
+    return json.dumps(payload)
+
+@app.route("/value")
+def get_value():
+    # Value stored out of line, by hash
+    payload = node.value_payload(request.args.get("hash"))
+    if payload is None:
+        return Response("Unknown value\n", status=404, mimetype="text/plain")
+    return json.dumps(payload)
+
 @app.route("/broadcast")
 def message_handler():
     # Retrieve data from the request
@@ -64,32 +210,8 @@ def message_handler():
     message = request.args.get('message')
     sender = request.args.get('sender')
 
-    broadcast_deliver = node.broadcast.deliver(message_type, message, sender)
-    if(not broadcast_deliver[0]):
-        return json.dumps({"deliver": True})
-
-    message_type, message, sender = broadcast_deliver[1]
-    if(message_type == "transaction"):
-        t = json.loads(message)
-        transaction = Transaction(t["key"], t["value"], t["origin"])
-        node.add_transaction(transaction, False)
-        return json.dumps({"deliver": True})
-
-    elif(message_type == 'block'):
-        block = json.loads(message)
-        transaction = []
-
-        for t in block["_transactions"]:
-            transaction.append(Transaction(t["key"], t["value"], t["origin"]))
-        new_block = Block(block["_index"], 
-                                transaction, 
-                                block["_timestamp"], 
-                                block["_previous_hash"],
-                                block["_nonce"])
-        node.confirm_block(new_block)
-        return json.dumps({"deliver": True})
-    else:
-        return 
+    node.deliver(message_type, message, sender)
+    return json.dumps({"deliver": True})
 
 @app.route("/peers")
 def get_peers():
@@ -110,45 +232,75 @@ def put():
     value = data['value']
     origin = data['origin']
 
-    # Add the transaction and returns an acknowledgement
-    node.add_transaction(Transaction(key,value,origin))
+    # Add the transaction and returns an acknowledgement, or ask
+    # the client to retry later if the node is overloaded. The rate is
+    # limited by address, as a client can put any origin in its request
+    retry_after = node.submit_transaction(Transaction(key,value,origin),
+                                          request.remote_addr)
+    if retry_after is not None:
+        return Response(json.dumps({"deliver": False, "retry_after": retry_after}),
+                        status=429, mimetype="application/json",
+                        headers={"Retry-After": str(math.ceil(retry_after))})
     return json.dumps({"deliver": True})
 
 
+@app.route("/ready")
+def ready():
+    # Tells whether the node has been bootstrapped
+    return json.dumps({"ready": node.is_ready()})
+
 @app.route("/retrieve")
 def retrieve():
-    value = None
     # Retrieve data from the request
     key = request.get_json(force=True)['key']
-    
-    # Iterate through blocks and transactions to find the 
-    # most recent value corresponding to the target key
-    chain = reversed(node.get_blocks())
-    for block in chain:
-        transactions = reversed(block.get_transactions())
-        for transaction in transactions:
-            if key == transaction.key:
-                value = transaction.value
-    return json.dumps({"value": value})
+    return json.dumps({"value": node.retrieve(key)})
 
 
 @app.route("/retrieve_all")
 def retrieve_all():
-    values = []
     # Retrieve data from the request
     key = request.get_json(force=True)['key']
+    return json.dumps({"values": node.retrieve_all(key)})
+
+def serve(port, server = "flask", threads = 8):
+    """
+    Serve the API with the requested WSGI server.
+
+    All the workers are threads of this process, so that the node
+    keeps exactly one `Blockchain` (and one miner) whatever the
+    number of workers.
+    """
+    if server == "waitress":
+        from waitress import serve as waitress_serve
+        waitress_serve(app, host="127.0.0.1", port=port, threads=threads)
+    else:
+        app.run(port=port, debug=False)
 
-    # Iterate through blocks and transactions to the 
-    # values corresponding to the target keys
-    chain = reversed(node.get_blocks())
-    for block in chain:
-        transactions = reversed(block.get_transactions())
-        for transaction in transactions:
-            if key == transaction.key:
-                values.append(transaction.value)
-    return json.dumps({"values": values})
 
 if __name__ == "__main__":
-    print("In init blockchain_app")
+    arguments = parse_arguments()
+    logging.basicConfig(level=arguments.log_level,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    node_profiler = Profiler() if arguments.profile else None
+    init_node(Blockchain(miner = arguments.miner, port = arguments.port,
+                            difficulty = arguments.difficulty,
+                            block_time = arguments.block_time,
+                            retarget_interval = arguments.retarget_interval,
+                            snapshot_interval = arguments.snapshot_interval,
+                            snapshot_history = arguments.snapshot_history,
+                            prune = arguments.prune,
+                            block_size = arguments.block_size,
+                            broadcast_mode = arguments.broadcast,
+                            block_relay = arguments.block_relay,
+                            sync_mode = arguments.sync,
+                            sync_range = arguments.sync_range,
+                            rate_limit = arguments.rate_limit,
+                            rate_burst = arguments.rate_burst,
+                            max_pending = arguments.max_pending,
+                            value_threshold = arguments.value_threshold,
+                            compression = arguments.compression,
+                            validation_processes = arguments.validation_processes,
+                            profiler = node_profiler),
+                node_profiler)
     Thread(target=node.bootstrap, args=(arguments.bootstrap,)).start()
-    app.run(port=arguments.port, debug=False)
+    serve(arguments.port, arguments.server, arguments.threads)
@@ -1,24 +1,48 @@
 from requests import get, post, exceptions
-from time import sleep
-from threading import Thread
+from hashlib import sha256
+from time import sleep, time
+from threading import Lock, Thread
+from urllib.parse import urlencode
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
 
 class Broadcast():
 
-    def __init__(self, peers, ip):
-        self._peers = peers
-        self._correct = peers
-        self._ip = ip
+    def __init__(self, peers, ip, mode = "reliable", transport = None, heartbeat = True,
+                    max_messages = 100000):
+        """
+        Init the broadcast. In the `reliable` mode (lazy reliable broadcast)
+        the messages of a crashed sender are relayed to the other peers,
+        in the `best-effort` mode they are not.
 
-        #Intialize the from dictionary for peers
-        self._from = {}
-        for peer in self._peers:
-            self._from[peer] = []
+        The messages are sent with the transport (HTTP by default). If
+        heartbeat is False, no heartbeat thread is started and the
+        heartbeat rounds must be run with `heartbeat_round`.
 
-        self._from[self._ip] = []
+        The messages already delivered are remembered by their hash over two
+        generations, the oldest one being dropped by `rotate` (when the node
+        adopts a snapshot) or once `max_messages` messages are remembered.
+        """
+        self._peers = peers
+        #Copy: the suspected peers are removed from the correct ones only
+        self._correct = set(peers)
+        self._ip = ip
+        self._mode = mode
+        self._transport = transport if transport is not None else HttpTransport()
+        self._uncorrect = {}
+
+        #Hashes of the messages delivered, by sender
+        self._max_messages = max_messages
+        self._delivered = set()
+        self._delivered_before = set()
+        self._lock = Lock()
         # Start heartbeat
-        self._heartbeat = True
-        heart_beat = Thread(target=self.heart_beat)
-        heart_beat.start()
+        self._heartbeat = heartbeat
+        if heartbeat:
+            heart_beat = Thread(target=self.heart_beat, daemon=True)
+            heart_beat.start()
 
     def add_peer(self, peer):
         """
@@ -28,7 +52,6 @@ class Broadcast():
         if peer not in self._peers and peer != self._ip:
             self._correct.add(peer)
             self._peers.add(peer)
-            self._from[peer] = []
 
     def get_peers(self):
         """
@@ -42,12 +65,38 @@ class Broadcast():
 
         Arguments:
         ----------
-        - `message_type`: type of message to send {transaction, block}
+        - `message_type`: type of message to send {transaction, block, compact_block}
         - `message`: message to send
         """
-        self._from[self._ip].append(message)
+        self._is_new(message, self._ip)
         self.beb_send(message_type, message, self._ip)
 
+    def _is_new(self, message, sender):
+        """
+        Remembers a message, returns False if it was already delivered.
+        """
+        message_id = sender + sha256(message.encode()).hexdigest()
+        with self._lock:
+            if message_id in self._delivered or message_id in self._delivered_before:
+                return False
+            if len(self._delivered) >= self._max_messages:
+                self._rotate()
+            self._delivered.add(message_id)
+        return True
+
+    def rotate(self):
+        """
+        Forgets the oldest generation of the messages delivered. A message
+        is only received again shortly after its broadcast, when it is
+        relayed by the other peers.
+        """
+        with self._lock:
+            self._rotate()
+
+    def _rotate(self):
+        self._delivered_before = self._delivered
+        self._delivered = set()
+
     def deliver(self, message_type, message, sender):
         """
         Deliver the message. If the sender is not
@@ -68,10 +117,9 @@ class Broadcast():
                             and the sender if the boolean is True.
                             An empty list otherwise
         """
-        if message not in self._from[sender]:
+        if self._is_new(message, sender):
             result = [message_type, message, sender]
-            self._from[sender].append(message)
-            if sender not in self._correct:
+            if sender not in self._correct and self._mode == "reliable":
                 # The sender is not a correct process anymore
                 self.beb_send(message_type, message, sender)
             return (True, result)
@@ -89,13 +137,16 @@ class Broadcast():
         - `message`: message to send
         - `sender`: adress of the sender
         """
-        for peer in self._peers:
-            print("Sending {} to peer {}".format(message_type, peer))
+        #Sorted, so that a simulation is reproducible
+        for peer in sorted(self._peers):
+            logger.debug("Sending %s to peer %s", message_type, peer)
             params = {"type": message_type, "message": message, "sender": sender}
+            start = time()
             try:
-                send_to_one(peer, "broadcast", params)
+                self._transport.send(peer, "broadcast", params)
             except exceptions.RequestException:
-                pass
+                logger.debug("Unable to send %s to peer %s", message_type, peer)
+            metrics.BROADCAST_LATENCY.observe(time() - start, peer=peer)
 
     def heart_beat(self):
         """
@@ -117,36 +168,65 @@ class Broadcast():
         If the process was marked as uncorrect and the heartbeat
         response does not raise error. The process is marked as correct
         """
-        uncorrect_process = {}
-        to_remove_correct = []
-        to_remove_peer = []
         while self._heartbeat:
-            for peer in self._peers:
-                to_remove_correct = []
-                to_remove_peer = []
-                try:
-                    send_to_one(peer, path="heartbeat")
-                except exceptions.RequestException:
-                    if peer in self._correct:
-                        to_remove_correct.append(peer)
-                        uncorrect_process[peer] = 1
-                        continue
-                        
-                    else:
-                        uncorrect_process[peer] += 1
-                        if uncorrect_process[peer] > 10:
-                            to_remove_peer.append(peer)
-                            del self._from[peer]
-                        continue
-
-                if peer not in self._correct:
-                    self._correct.add(peer)
-            for peer in to_remove_correct:
-                self._correct.remove(peer)
-            for peer in to_remove_peer:
-                self._peers.remove(peer)
+            self.heartbeat_round()
             sleep(10)
 
+    def heartbeat_round(self):
+        """
+        Send one heartbeat to every peer (see `heart_beat`).
+        """
+        to_remove_correct = []
+        to_remove_peer = []
+        for peer in sorted(self._peers):
+            try:
+                self._transport.send(peer, path="heartbeat")
+            except exceptions.RequestException:
+                metrics.HEARTBEAT_FAILURES.inc(peer=peer)
+                if peer in self._correct:
+                    to_remove_correct.append(peer)
+                    self._uncorrect[peer] = 1
+                    continue
+
+                else:
+                    self._uncorrect[peer] += 1
+                    if self._uncorrect[peer] > 10:
+                        to_remove_peer.append(peer)
+                    continue
+
+            if peer not in self._correct:
+                self._correct.add(peer)
+        for peer in to_remove_correct:
+            self._correct.remove(peer)
+        for peer in to_remove_peer:
+            self._peers.remove(peer)
+
+
+class HttpTransport():
+
+    def send(self, peer, path, message = ""):
+        """
+        Send a message to a particular node with a HTTP GET request
+
+        Arguments:
+        ----------
+        - `peer`: the node to send the message
+        - `path`: route of the node
+        - `message`: parameters of the request
+
+        Returns:
+        ----------
+        - the response of the node, an exceptions.RequestException
+            is raised if the node did not answer with a 200
+        """
+        url = "http://{}/{}".format(peer, path)
+        metrics.BYTES_SENT.inc(len(url) + len(urlencode(message or {})), path=path)
+        response = get(url, params=message, timeout = 10)
+        metrics.BYTES_RECEIVED.inc(len(response.content), path=path)
+        if response.status_code != 200:
+            raise exceptions.RequestException('Bad return error')
+        return response
+
 
 def send_to_one(peer, path, message = ""):
     """
@@ -155,11 +235,7 @@ def send_to_one(peer, path, message = ""):
     Arguments:
     ----------
     - `peer`: the node to send the message
-    - `path`: message to send
-    - `sender`: adress of the sender
+    - `path`: route of the node
+    - `message`: parameters of the request
     """
-    url = "http://{}/{}".format(peer, path)
-    response = get(url, params=message, timeout = 10)
-    if response.status_code != 200:
-        raise exceptions.RequestException('Bad return error')
-    return response
\ No newline at end of file
+    return HttpTransport().send(peer, path, message)
@@ -0,0 +1,212 @@
+"""
+Node metrics, exposed in the Prometheus text format by the `/metrics` route.
+"""
+import threading
+
+
+#Default buckets of the latency histograms (seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+def _format_labels(labels, extra = ()):
+    """
+    Returns the Prometheus representation of a set of labels.
+    """
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def percentile(values, q):
+    """
+    Returns the `q` quantile (0 to 1) of some values, None if there is none.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Metric:
+    def __init__(self, name, description, kind):
+        """Init a metric. The values are stored by label set (a sorted
+        tuple of (name, value) pairs).
+        """
+        self._name = name
+        self._description = description
+        self._kind = kind
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """
+        Returns the metric in the Prometheus text format.
+        """
+        lines = ["# HELP {} {}".format(self._name, self._description),
+                 "# TYPE {} {}".format(self._name, self._kind)]
+        with self._lock:
+            samples = list(self._values.items())
+        for labels, value in samples:
+            lines.append("{}{} {}".format(self._name, _format_labels(labels),
+                                          _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    def __init__(self, name, description):
+        Metric.__init__(self, name, description, "counter")
+
+    def inc(self, amount = 1, **labels):
+        """
+        Increments the counter of the labels.
+        """
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    def __init__(self, name, description):
+        Metric.__init__(self, name, description, "gauge")
+        self._function = None
+
+    def set(self, value, **labels):
+        """
+        Sets the value of the gauge for the labels.
+        """
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function):
+        """
+        Computes the (unlabelled) value of the gauge with `function`
+        each time the metrics are rendered.
+        """
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            self.set(self._function())
+        return Metric.render(self)
+
+
+class Histogram(Metric):
+    def __init__(self, name, description, buckets = LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, "histogram")
+        self._buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        """
+        Records an observation for the labels.
+        """
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(labels, ([0] * len(self._buckets), 0))
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[labels] = (counts, total + value)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self._name, self._description),
+                 "# TYPE {} histogram".format(self._name)]
+        with self._lock:
+            samples = [(labels, list(counts), total)
+                       for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in samples:
+            for bound, count in zip(self._buckets, counts):
+                lines.append("{}_bucket{} {}".format(self._name,
+                             _format_labels(labels, [("le", _format_value(bound))]), count))
+            lines.append("{}_sum{} {}".format(self._name, _format_labels(labels),
+                                              _format_value(total)))
+            lines.append("{}_count{} {}".format(self._name, _format_labels(labels),
+                                                counts[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """Init an empty set of metrics.
+        """
+        self._metrics = []
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry and returns it.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns all the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+#Mining
+HASHES = REGISTRY.register(Counter(
+    "keychain_pow_hashes_total", "Number of hashes computed by the proof of work"))
+HASH_RATE = REGISTRY.register(Gauge(
+    "keychain_pow_hash_rate", "Hashes per second of the last proof of work"))
+POW_ATTEMPTS = REGISTRY.register(Histogram(
+    "keychain_pow_attempts", "Number of hashes needed to mine a block",
+    buckets=[4 ** i for i in range(13)]))
+BLOCKS_MINED = REGISTRY.register(Counter(
+    "keychain_blocks_mined_total", "Number of blocks mined by the node"))
+
+#Chain
+MEMPOOL_SIZE = REGISTRY.register(Gauge(
+    "keychain_mempool_size", "Number of pending transactions"))
+REFUSED_TRANSACTIONS = REGISTRY.register(Counter(
+    "keychain_refused_transactions_total", "Number of transactions refused by "
+    "the admission control, by reason (rate limit of the client address, full mempool)"))
+VALUE_FETCHES = REGISTRY.register(Counter(
+    "keychain_value_fetches_total", "Values stored out of line fetched from "
+    "the other nodes, by outcome"))
+BRANCHES = REGISTRY.register(Gauge(
+    "keychain_branches", "Number of branches waiting to be added to the master chain"))
+FORKS = REGISTRY.register(Counter(
+    "keychain_forks_total", "Number of blocks that created a new branch"))
+REJECTED_BLOCKS = REGISTRY.register(Counter(
+    "keychain_rejected_blocks_total", "Number of invalid blocks by reason"))
+BLOCK_COMMIT_LATENCY = REGISTRY.register(Histogram(
+    "keychain_block_commit_seconds", "Time between the creation of a block and "
+    "its addition to the master chain"))
+
+SYNC_RANGES = REGISTRY.register(Counter(
+    "keychain_sync_ranges_total", "Block ranges downloaded from the peers "
+    "while bootstrapping, by outcome"))
+
+#Broadcast
+BROADCAST_LATENCY = REGISTRY.register(Histogram(
+    "keychain_broadcast_send_seconds", "Time to send a broadcast message to a peer"))
+BYTES_SENT = REGISTRY.register(Counter(
+    "keychain_bytes_sent_total", "Bytes of requests sent to the other nodes"))
+BYTES_RECEIVED = REGISTRY.register(Counter(
+    "keychain_bytes_received_total", "Bytes of responses received from the other nodes"))
+COMPACT_BLOCKS = REGISTRY.register(Counter(
+    "keychain_compact_blocks_total", "Compact blocks received, by outcome (rebuilt "
+    "from the pool, with fetched transactions, failed)"))
+COMPACT_BLOCK_MISSING = REGISTRY.register(Counter(
+    "keychain_compact_block_missing_total", "Transactions of compact blocks fetched "
+    "from the other nodes"))
+HEARTBEAT_FAILURES = REGISTRY.register(Counter(
+    "keychain_heartbeat_failures_total", "Number of heartbeats without answer"))
+
+#API
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "keychain_request_seconds", "Time to handle a request of the API"))
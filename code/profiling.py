@@ -0,0 +1,157 @@
+"""
+Opt-in profiling of a node (`blockchain_app.py --profile`).
+
+A sampling profiler: a thread takes the stack of every profiled thread
+at a fixed interval and charges it to the subsystem the thread works for.
+Unlike cProfile, of which only one can be active per process on recent
+Pythons (3.12+), the miner and every request handler can be profiled
+at the same time.
+"""
+import io
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+SORT_KEYS = {"cumulative": 1, "cumtime": 1, "self": 0, "tottime": 0, "time": 0}
+
+
+class Samples:
+    __slots__ = ("samples", "functions")
+
+    def __init__(self):
+        """Init the samples of a subsystem: the number of samples, and for
+        each function (file, line, name) the number of samples in which it
+        was running (self) and on the stack (cumulative).
+        """
+        self.samples = 0
+        self.functions = {}
+
+    def add_stack(self, frame):
+        self.samples += 1
+        seen = set()
+        leaf = True
+        while frame is not None:
+            code = frame.f_code
+            function = (code.co_filename, code.co_firstlineno, code.co_name)
+            counts = self.functions.get(function)
+            if counts is None:
+                counts = self.functions[function] = [0, 0]
+            if leaf:
+                counts[0] += 1
+                leaf = False
+            # A recursive function is counted once per sample
+            if function not in seen:
+                counts[1] += 1
+                seen.add(function)
+            frame = frame.f_back
+
+    def add(self, other):
+        self.samples += other.samples
+        for function, (own, cumulative) in other.functions.items():
+            counts = self.functions.setdefault(function, [0, 0])
+            counts[0] += own
+            counts[1] += cumulative
+
+
+class Profiler:
+    def __init__(self, interval = 0.005):
+        """Init the profiler. The stacks of the profiled threads are sampled
+        every `interval` seconds, and the samples are accumulated by subsystem
+        (the miner, each route of the API, ...).
+        """
+        self._interval = interval
+        self._stats = {}
+        self._active = {} #Samples of the profiled threads by thread id
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def start(self):
+        """
+        Starts profiling the calling thread and returns the profile,
+        or None if the thread is already profiled.
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            if thread_id in self._active:
+                return None
+            samples = self._active[thread_id] = Samples()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        return samples
+
+    def stop(self, subsystem, profile):
+        """
+        Stops a profile returned by `start` and adds it to the subsystem.
+        """
+        if profile is None:
+            return
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+            if subsystem in self._stats:
+                self._stats[subsystem].add(profile)
+            else:
+                self._stats[subsystem] = profile
+
+    @contextmanager
+    def profile(self, subsystem):
+        """
+        Profiles the calling thread while in the context.
+        """
+        profile = self.start()
+        try:
+            yield
+        finally:
+            self.stop(subsystem, profile)
+
+    def _sample(self):
+        while True:
+            time.sleep(self._interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples.add_stack(frame)
+
+    def subsystems(self):
+        """
+        Returns the names of the profiled subsystems.
+        """
+        with self._lock:
+            return sorted(self._stats)
+
+    def dump(self, subsystem, sort = "cumulative", limit = 40):
+        """
+        Returns the statistics of a subsystem as text (None if unknown).
+        The functions are sorted by the samples in which they were on the
+        stack (cumulative) or running (self).
+        """
+        column = SORT_KEYS.get(sort, 1)
+        with self._lock:
+            if subsystem not in self._stats:
+                return None
+            stats = self._stats[subsystem]
+            total = stats.samples
+            functions = sorted(stats.functions.items(),
+                               key=lambda item: item[1][column], reverse=True)[:limit]
+        stream = io.StringIO()
+        stream.write("{} samples of {} (every {:g} ms)\n\n".format(
+                        total, subsystem, self._interval * 1000))
+        stream.write("{:>8} {:>7} {:>8} {:>7}  function\n".format(
+                        "self", "self%", "cumul", "cumul%"))
+        for (filename, line, name), (own, cumulative) in functions:
+            stream.write("{:>8} {:>6.1f}% {:>8} {:>6.1f}%  {}:{}({})\n".format(
+                            own, 100.0 * own / max(total, 1),
+                            cumulative, 100.0 * cumulative / max(total, 1),
+                            filename, line, name))
+        return stream.getvalue()
+
+    def reset(self):
+        """
+        Drops all the statistics.
+        """
+        with self._lock:
+            self._stats = {}
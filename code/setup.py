@@ -23,12 +23,14 @@ with open(os.path.join("keychain", "__init__.py"), "rt") as fh:
 
 # Module requirements.
 _install_requires = [
+    "aiohttp",
     "argparse",
     "flask",
     "hashlib",
     "numpy",
     "requists",
-    "time"
+    "time",
+    "waitress"
 ]
 
 _parameters = {
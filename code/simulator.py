@@ -0,0 +1,454 @@
+"""
+In-process simulation of a KeyChain network.
+
+The nodes are `Blockchain` objects sharing one process: their messages go
+through a simulated network (latency, message loss, partitions and crashed
+nodes) driven by a virtual clock, so that hundreds of nodes run in seconds.
+The proof of work is replaced by a Poisson process: each miner finds a block
+every `nodes * block_time` seconds on average. The requests of the nodes (the
+missing transactions of a compact block, the bootstrap) are answered at once,
+the round trips made while handling a block being added to its delivery time.
+
+Reports the block propagation delay, the fork rate (mined blocks that did
+not end in the master chain) and the messages sent per committed transaction.
+A run is reproducible for a given `--seed`.
+
+Usage:
+    python simulator.py --nodes 200 --duration 600 --block-time 10 \
+        --rate 5 --latency 0.05 0.5 --loss 0.01 --crashes 10 \
+        --partition-at 200 --partition-duration 60
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import random
+from urllib.parse import urlencode
+
+from requests import exceptions
+
+from blockchain import Block, Blockchain, Transaction, difficulty_to_target
+from metrics import percentile
+
+
+BLOCK_MESSAGES = ("block", "compact_block")
+
+
+class VirtualClock():
+
+    def __init__(self):
+        """Init the clock at time 0, without scheduled events.
+        """
+        self._now = 0.0
+        self._events = []
+        self._counter = itertools.count()
+
+    def now(self):
+        return self._now
+
+    def schedule(self, delay, callback, *args):
+        """
+        Calls `callback(*args)` in `delay` seconds (virtual time).
+        """
+        heapq.heappush(self._events, (self._now + delay, next(self._counter),
+                                      callback, args))
+
+    def run(self, until):
+        """
+        Runs the events scheduled before `until` in order, then sets
+        the time to `until`.
+        """
+        while self._events and self._events[0][0] <= until:
+            self._now, _, callback, args = heapq.heappop(self._events)
+            callback(*args)
+        self._now = until
+
+
+class SimulatedResponse():
+
+    def __init__(self, content = None):
+        self.status_code = 200
+        self._content = content if content is not None else {}
+
+    def json(self):
+        return self._content
+
+
+class SimulatedNetwork():
+
+    def __init__(self, clock, latency = (0.01, 0.1), loss = 0.0, seed = None,
+                    bandwidth = None, synchronous = False):
+        """
+        Init the network. Each message is delivered after a latency drawn
+        uniformly in `latency` (seconds), plus its transmission time if the
+        `bandwidth` of the links is set (bytes per second), or lost with
+        probability `loss`. If `synchronous`, the broadcasts are delivered
+        before `send` returns, as with the HTTP transport.
+        """
+        self._clock = clock
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._loss = loss
+        self._random = random.Random(seed)
+        self._nodes = {}
+        self._crashed = set()
+        self._partitions = []
+        self._synchronous = synchronous
+
+        #Statistics
+        self._messages = {}
+        self._bytes = {}
+        self._last_size = (None, 0)
+        self._delay = 0 #Round trips of the requests made by the current delivery
+        self._published = {} #Publication time of the blocks (by message)
+        self._received = {} #Delivery times of the blocks (by message)
+
+    def add_node(self, address, node):
+        self._nodes[address] = node
+
+    def crash(self, address):
+        """
+        Crashes a node: it does not answer or mine anymore.
+        """
+        self._crashed.add(address)
+
+    def is_crashed(self, address):
+        return address in self._crashed
+
+    def partition(self, groups):
+        """
+        Splits the network: only the nodes of a same group can communicate.
+        """
+        self._partitions = [set(group) for group in groups]
+
+    def heal(self):
+        self._partitions = []
+
+    def reachable(self, sender, peer):
+        if peer in self._crashed or sender in self._crashed:
+            return False
+        if not self._partitions:
+            return True
+        return any(sender in group and peer in group for group in self._partitions)
+
+    def send(self, sender, peer, path, message = ""):
+        """
+        Sends a message from `sender` to `peer`, with the semantics of
+        `broadcast.HttpTransport.send`: an exceptions.RequestException is
+        raised if the peer cannot be reached.
+        """
+        size = len(path) + self._size(message)
+        self._messages[path] = self._messages.get(path, 0) + 1
+        self._bytes[path] = self._bytes.get(path, 0) + size
+
+        if not self.reachable(sender, peer):
+            raise exceptions.ConnectionError("{} is unreachable".format(peer))
+        if self._random.random() < self._loss:
+            raise exceptions.Timeout("Message to {} lost".format(peer))
+
+        node = self._nodes[peer]
+        if path == "broadcast":
+            if message["type"] in BLOCK_MESSAGES and message["sender"] == sender:
+                self._published.setdefault(message["message"], self._clock.now())
+            if self._synchronous:
+                self._deliver(peer, node, message)
+            else:
+                self._clock.schedule(self._transmission(size), self._deliver,
+                                     peer, node, message)
+            return SimulatedResponse({"deliver": True})
+        if path == "heartbeat":
+            return SimulatedResponse({"deliver": True})
+
+        content = self._respond(sender, node, path, message)
+        response_size = len(json.dumps(content))
+        self._bytes[path] += response_size
+        self._delay += self._transmission(size) + self._transmission(response_size)
+        return SimulatedResponse(content)
+
+    def _respond(self, sender, node, path, message):
+        """
+        Returns the answer of a node to a request (see the routes
+        of `blockchain_app.py`).
+        """
+        if path == "peers":
+            return {"peers": sorted(node.get_peers())}
+        if path == "addNode":
+            node.add_node(message["address"])
+            return node.get_last_master_hash()
+        if path == "headers":
+            return node.headers_payload()
+        if path == "blockchain":
+            return node.chain_payload()
+        if path == "blocks":
+            end = message.get("end")
+            payload = node.block_range_payload(int(message["start"]),
+                                               int(end) if end is not None else None)
+        elif path == "value":
+            payload = node.value_payload(message["hash"])
+        elif path == "blockTransactions":
+            payload = node.block_transactions_payload(
+                message["hash"], [int(i) for i in message["indexes"].split(",") if i])
+        else:
+            raise exceptions.RequestException("Unknown path {}".format(path))
+        if payload is None:
+            # The routes answer 404
+            raise exceptions.RequestException("Not found: {}".format(path))
+        return payload
+
+    def _transmission(self, size):
+        """
+        Returns the time to send `size` bytes to a peer.
+        """
+        delay = self._random.uniform(*self._latency)
+        if self._bandwidth:
+            delay += size / self._bandwidth
+        return delay
+
+    def _size(self, message):
+        """
+        Returns the size of the encoded parameters of a request. A broadcast
+        sends the same message to every peer, so the last size is cached.
+        """
+        if not message:
+            return 0
+        key = tuple(sorted(message.items()))
+        if key != self._last_size[0]:
+            self._last_size = (key, len(urlencode(message)))
+        return self._last_size[1]
+
+    def _deliver(self, peer, node, message):
+        if peer in self._crashed:
+            return
+        self._delay = 0
+        node.deliver(message["type"], message["message"], message["sender"])
+        if message["type"] in BLOCK_MESSAGES:
+            self._received.setdefault(message["message"], {}).setdefault(
+                peer, self._clock.now() + self._delay)
+
+    def statistics(self):
+        """
+        Returns the messages and bytes sent by path, and for each block
+        published the delays until it was delivered to the other nodes.
+        """
+        delays = {}
+        for message, published in self._published.items():
+            delays[message] = [received - published
+                               for received in self._received.get(message, {}).values()]
+        return dict(self._messages), dict(self._bytes), delays
+
+
+class SimulatedTransport():
+
+    def __init__(self, network, address):
+        """Transport of the node at `address` on a simulated network.
+        """
+        self._network = network
+        self._address = address
+
+    def send(self, peer, path, message = ""):
+        return self._network.send(self._address, peer, path, message)
+
+
+class Simulation():
+
+    def __init__(self, nodes = 10, block_time = 10, rate = 1, latency = (0.01, 0.1),
+                    loss = 0.0, broadcast_mode = "reliable", block_size = 0,
+                    heartbeat = True, seed = None, block_relay = "compact",
+                    bandwidth = None):
+        """
+        Init a network of `nodes` miners sharing the same genesis block,
+        each node being a peer of all the others. Transactions are
+        submitted to random nodes at `rate` per second.
+        """
+        self.clock = VirtualClock()
+        self.network = SimulatedNetwork(self.clock, latency, loss, seed, bandwidth)
+        self._random = random.Random(seed)
+        self._block_time = block_time
+        self._rate = rate
+        self._heartbeat = heartbeat
+        self._keys = itertools.count()
+        self._submitted = {} #Submission time of the keys
+        self._committed = {} #Commit time of the keys (on the first node)
+        self._scanned = 0
+        self._mined = 0
+
+        self.nodes = []
+        for port in range(nodes):
+            address = "127.0.0.1:{}".format(port)
+            node = Blockchain(port=port, miner=True,
+                              difficulty=0, retarget_interval=0,
+                              block_size=block_size, broadcast_mode=broadcast_mode,
+                              block_relay=block_relay,
+                              transport=SimulatedTransport(self.network, address),
+                              heartbeat=False, mining_thread=False)
+            self.network.add_node(address, node)
+            self.nodes.append(node)
+
+        # Genesis block on the virtual clock, so that a run is reproducible
+        genesis = Block(0, [], self.clock.now(), "0", target=difficulty_to_target(0))
+        for node in self.nodes:
+            node._set_chain([genesis], genesis.compute_hash())
+            for peer in self.nodes:
+                node.add_node(peer._get_ip())
+
+    def crash(self, node, at):
+        """
+        Crashes a node at time `at`.
+        """
+        self.clock.schedule(at - self.clock.now(), self.network.crash, node._get_ip())
+
+    def partition(self, groups, at, duration):
+        """
+        Splits the nodes in groups at time `at`, during `duration` seconds.
+        """
+        addresses = [[node._get_ip() for node in group] for group in groups]
+        self.clock.schedule(at - self.clock.now(), self.network.partition, addresses)
+        self.clock.schedule(at + duration - self.clock.now(), self.network.heal)
+
+    def run(self, duration):
+        """
+        Runs the network during `duration` seconds (virtual time).
+        """
+        for node in self.nodes:
+            self._schedule_block(node)
+        if self._rate > 0:
+            self.clock.schedule(self._random.expovariate(self._rate), self._submit)
+        if self._heartbeat:
+            self.clock.schedule(10, self._heartbeat_round)
+        self.clock.schedule(1, self._scan_commits)
+        self.clock.run(self.clock.now() + duration)
+        self._scan_commits(reschedule=False)
+
+    def _schedule_block(self, node):
+        delay = self._random.expovariate(1 / (self._block_time * len(self.nodes)))
+        self.clock.schedule(delay, self._mine, node)
+
+    def _mine(self, node):
+        if self.network.is_crashed(node._get_ip()):
+            return
+        if node.get_pending_transactions():
+            node._publish_block(node._new_block(timestamp=self.clock.now()))
+            self._mined += 1
+        self._schedule_block(node)
+
+    def _submit(self):
+        live = [node for node in self.nodes if not self.network.is_crashed(node._get_ip())]
+        if live:
+            key = "key-{}".format(next(self._keys))
+            self._submitted[key] = self.clock.now()
+            self._random.choice(live).add_transaction(
+                Transaction(key, self.clock.now(), "simulator"))
+        self.clock.schedule(self._random.expovariate(self._rate), self._submit)
+
+    def _heartbeat_round(self):
+        for node in self.nodes:
+            if not self.network.is_crashed(node._get_ip()):
+                node.broadcast.heartbeat_round()
+        self.clock.schedule(10, self._heartbeat_round)
+
+    def _scan_commits(self, reschedule = True):
+        chain = self.nodes[0].get_blocks()
+        for block in chain[self._scanned:]:
+            for transaction in block.get_transactions():
+                self._committed.setdefault(transaction.key, self.clock.now())
+        self._scanned = len(chain)
+        if reschedule:
+            self.clock.schedule(1, self._scan_commits)
+
+    def report(self):
+        """
+        Returns the statistics of the run.
+        """
+        messages, sizes, delays = self.network.statistics()
+        live = [node for node in self.nodes if not self.network.is_crashed(node._get_ip())]
+        full = [max(d) for d in delays.values() if len(d) >= len(live) - 1 and d]
+        all_delays = [delay for d in delays.values() for delay in d]
+        chain = self.nodes[0].get_blocks()
+        latencies = [self._committed[key] - self._submitted[key]
+                     for key in self._submitted if key in self._committed]
+        committed = len(latencies)
+        # Nodes whose master chain is a prefix of the first node's one (or the converse)
+        consistent = sum(1 for node in live if all(
+            a.compute_hash() == b.compute_hash()
+            for a, b in zip(node.get_blocks(), chain)))
+        return {"nodes": len(self.nodes), "live_nodes": len(live),
+                "time": self.clock.now(), "blocks_mined": self._mined,
+                "blocks_committed": len(chain) - 1,
+                "fork_rate": 1 - (len(chain) - 1) / self._mined if self._mined else None,
+                "propagation_p50": percentile(all_delays, 0.5),
+                "propagation_p90": percentile(all_delays, 0.9),
+                "propagation_full_p50": percentile(full, 0.5),
+                "submitted": len(self._submitted), "committed": committed,
+                "commit_latency_p50": percentile(latencies, 0.5),
+                "commit_latency_p90": percentile(latencies, 0.9),
+                "messages": sum(messages.values()), "bytes": sum(sizes.values()),
+                "messages_by_path": messages,
+                "messages_per_transaction": sum(messages.values()) / committed if committed else None,
+                "bytes_per_transaction": sum(sizes.values()) / committed if committed else None,
+                "consistent_nodes": consistent}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("KeyChain network simulator")
+    parser.add_argument("--nodes", type=int, default=100,
+                        help="Number of nodes")
+    parser.add_argument("--duration", type=float, default=600,
+                        help="Simulated time in seconds")
+    parser.add_argument("--block-time", type=float, default=10,
+                        help="Average time between two blocks of the network")
+    parser.add_argument("--block-size", type=int, default=0,
+                        help="Maximum number of transactions per block (0 for no limit)")
+    parser.add_argument("--rate", type=float, default=1,
+                        help="Transactions submitted per second")
+    parser.add_argument("--latency", type=float, nargs=2, default=[0.01, 0.1],
+                        help="Minimum and maximum latency of a message in seconds")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="Bandwidth of the links in bytes per second (unlimited by default)")
+    parser.add_argument("--loss", type=float, default=0,
+                        help="Probability that a message is lost")
+    parser.add_argument("--broadcast", type=str, default="reliable",
+                        choices=["reliable", "best-effort"],
+                        help="Broadcast mode of the nodes")
+    parser.add_argument("--block-relay", type=str, default="compact",
+                        choices=["compact", "full"],
+                        help="Block relay of the nodes")
+    parser.add_argument("--crashes", type=int, default=0,
+                        help="Number of nodes crashed at random times")
+    parser.add_argument("--partition-at", type=float, default=None,
+                        help="Time at which the network is split in two halves")
+    parser.add_argument("--partition-duration", type=float, default=60,
+                        help="Duration of the partition in seconds")
+    parser.add_argument("--no-heartbeat", action="store_true",
+                        help="Do not run the failure detector")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed of the simulation")
+    parser.add_argument("--log-level", type=str, default="WARNING",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging level of the nodes")
+    return parser.parse_args()
+
+
+def main(arguments):
+    logging.basicConfig(level=arguments.log_level,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    simulation = Simulation(arguments.nodes, arguments.block_time, arguments.rate,
+                            tuple(arguments.latency), arguments.loss, arguments.broadcast,
+                            arguments.block_size, not arguments.no_heartbeat,
+                            arguments.seed, arguments.block_relay, arguments.bandwidth)
+    # The first node is the reference of the report, it never crashes
+    rng = random.Random(arguments.seed)
+    for node in rng.sample(simulation.nodes[1:], min(arguments.crashes, arguments.nodes - 1)):
+        simulation.crash(node, rng.uniform(0, arguments.duration))
+    if arguments.partition_at is not None:
+        half = len(simulation.nodes) // 2
+        simulation.partition([simulation.nodes[:half], simulation.nodes[half:]],
+                             arguments.partition_at, arguments.partition_duration)
+
+    simulation.run(arguments.duration)
+    for name, value in simulation.report().items():
+        print("{}: {}".format(name, value))
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -2,11 +2,99 @@
 KeyChain key-value store (stub).
 """
 from threading import Thread
-from time import sleep
+from time import sleep, time
 import json
+import random
 import argparse
 import subprocess
-from requests import get
+from requests import get, exceptions
+from blockchain import Blockchain, Transaction
+
+
+def launch_node(bootstrap, miner, port, server = "flask"):
+    """
+    Launch the flask application hosting the blockchain node
+    and returns the process together with its address, without
+    waiting for the node to be ready.
+    """
+    process = subprocess.Popen(["python" ,"blockchain_app.py", "--miner", str(miner), "--bootstrap", str(bootstrap), "--port", str(port), "--server", server])
+    ip = "127.0.0.1"
+    address = "{}:{}".format(ip,port)
+    return process, address
+
+
+def start_node(bootstrap, miner, port, server = "flask", timeout = 30):
+    """
+    Launch the flask application hosting the blockchain node
+    and returns the process together with its address, once the
+    node reports that it is ready.
+    """
+    process, address = launch_node(bootstrap, miner, port, server)
+    wait_ready(address, process, timeout)
+    return process, address
+
+
+def wait_ready(address, process, timeout = 30):
+    """
+    Readiness handshake: poll the `/ready` route of the node until
+    it has been bootstrapped.
+    """
+    url = "http://{}/ready".format(address)
+    deadline = time() + timeout
+    while time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The blockchain node exited during startup")
+        try:
+            if get(url, timeout = 1).json()["ready"]:
+                return
+        except (exceptions.RequestException, ValueError):
+            # The server is not listening yet
+            pass
+        sleep(0.05)
+    raise RuntimeError("The blockchain node is not ready after {} seconds".format(timeout))
+
+
+#Backoff of the puts refused by an overloaded node (seconds)
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 30
+
+
+def backoff_delay(attempt, retry_after = None):
+    """
+    Returns the time to wait before the retry `attempt` (from 0) of a
+    refused put: the delay asked by the node (Retry-After) if any,
+    at least an exponential backoff, with a random jitter so that the
+    refused clients do not retry all at once.
+    """
+    delay = max(retry_after or 0, BACKOFF_BASE * 2 ** attempt)
+    return min(delay, BACKOFF_MAX) * random.uniform(1, 1.25)
+
+
+def retry_after(result):
+    """
+    Returns the delay asked by a node refusing a request (429), from the
+    body of the answer, or its Retry-After header (seconds).
+    """
+    try:
+        return float(result.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        try:
+            return float(result.headers.get("Retry-After"))
+        except (ValueError, TypeError):
+            return None
+
+
+def start_embedded_node(bootstrap, miner, port, server = "flask"):
+    """
+    Create the blockchain node in this process, serve its API
+    to the other nodes from a thread and bootstrap it.
+    """
+    import blockchain_app
+    node = Blockchain(miner = miner, port = port)
+    blockchain_app.init_node(node)
+    Thread(target=blockchain_app.serve, args=(port, server), daemon=True).start()
+    node.bootstrap(bootstrap)
+    return node
 
 
 class Callback:
@@ -33,16 +121,30 @@ class Callback:
 
 class Storage():
     
-    def __init__(self, bootstrap, miner, port = 5000):
+    def __init__(self, bootstrap, miner, port = 5000, server = "flask", embedded = False,
+                 max_retries = 5):
         """
         Allocate the backend storage of the high level API, i.e.,
         your blockchain. Depending whether or not the miner flag has
         been specified, you should allocate the mining process.
+        The server argument selects the WSGI server of the node
+        (see `blockchain_app.py --server`).
+
+        If embedded is True, the node is hosted in this process: local
+        operations call the blockchain directly and the API is only
+        served (from a thread) for the other nodes.
+
+        A put refused by an overloaded node is retried up to `max_retries`
+        times (see `backoff_delay`).
         """
-        self.blockchain_app = subprocess.Popen(["python" ,"blockchain_app.py", "--miner", str(miner), "--bootstrap", str(bootstrap), "--port", str(port)])
-        ip = "127.0.0.1"
-        self._address = "{}:{}".format(ip,port)
-        sleep(5)
+        self._max_retries = max_retries
+        if embedded:
+            self.blockchain_app = None
+            self._node = start_embedded_node(bootstrap, miner, port, server)
+            self._address = self._node._get_ip()
+        else:
+            self.blockchain_app, self._address = start_node(bootstrap, miner, port, server)
+            self._node = None
 
     def put(self, key, value, block=True):
         """
@@ -50,13 +152,29 @@ class Storage():
         The block flag indicates whether the call should block until the value
         has been put onto the blockchain, or if an error occurred.
         """
-        url = "http://{}/put".format(self._address)
-        result = get(url, data=json.dumps({"key": key, "value": value, "origin": self._address}),timeout = 10)
-        
-        if result.status_code != 200:
-            print("Unable to put transaction on the blockchain")
-            return
-        
+        attempt = 0
+        while True:
+            if self._node is not None:
+                delay = self._node.submit_transaction(Transaction(key, value, self._address))
+                if delay is None:
+                    break
+            else:
+                url = "http://{}/put".format(self._address)
+                result = get(url, data=json.dumps({"key": key, "value": value, "origin": self._address}),timeout = 10)
+                if result.status_code == 200:
+                    break
+                if result.status_code != 429:
+                    print("Unable to put transaction on the blockchain")
+                    return
+                delay = retry_after(result)
+
+            # The node is overloaded
+            if attempt >= self._max_retries:
+                print("Unable to put transaction on the blockchain (node overloaded)")
+                return
+            sleep(backoff_delay(attempt, delay))
+            attempt += 1
+
         callback = Callback(self, key, value)
         if block:
             callback.wait()
@@ -71,6 +189,8 @@ class Storage():
         or implement some indexing schemes if you would like to do something
         more efficient.
         """
+        if self._node is not None:
+            return self._node.retrieve(key)
        # Get the value of the most recent transaction corresponding to key
         url = "http://{}/retrieve".format(self._address)
         result = get(url, data=json.dumps({"key": key}))
@@ -86,6 +206,8 @@ class Storage():
         Retrieves all values associated with the specified key on the
         complete blockchain.
         """
+        if self._node is not None:
+            return self._node.retrieve_all(key)
         # Get the values of the transactions corresponding to key
         url = "http://{}/retrieve_all".format(self._address)
         result = get(url, data=json.dumps({"key": key}))
@@ -99,4 +221,5 @@ class Storage():
         """
         Kill the flask application when the Storage is deleted.
         """
-        self.blockchain_app.kill()
+        if self.blockchain_app is not None:
+            self.blockchain_app.kill()
@@ -1,7 +1,38 @@
 import unittest
 import time
+import json
+import threading
 
-from blockchain import Blockchain, Block, Transaction
+from blockchain import Blockchain, Block, Snapshot, Transaction, TransactionEncoder
+from metrics import Counter, Histogram
+from profiling import Profiler
+from blockchain import block_work, difficulty_to_target, next_target, validate_chain
+from admission import AdmissionControl
+from broadcast import Broadcast
+from store import backoff_delay
+from values import ValueStore, is_reference
+from simulator import Simulation, SimulatedNetwork, SimulatedTransport, VirtualClock
+
+
+def make_nodes(count, network = None, joining = False, **kwargs):
+    """
+    Returns the network (a new simulated network if None) and `count` nodes
+    on it, not mining and without heartbeat. If `joining` is True only the
+    first node has a genesis block, the others are to be bootstrapped.
+    The other arguments are passed to the nodes.
+    """
+    if network is None:
+        network = SimulatedNetwork(VirtualClock())
+    arguments = {"miner": False, "difficulty": 0, "heartbeat": False}
+    arguments.update(kwargs)
+    nodes = []
+    for port in range(count):
+        transport = SimulatedTransport(network, "127.0.0.1:{}".format(port))
+        node = Blockchain(port=port, unitTests=port == 0 or not joining,
+                            transport=transport, **arguments)
+        network.add_node(node._get_ip(), node)
+        nodes.append(node)
+    return network, nodes
 
 class UnitTestBlockchain(unittest.TestCase):
 
@@ -30,6 +61,329 @@ class UnitTestBlockchain(unittest.TestCase):
         self.assertTrue(blockchain.is_valid())
         self.assertTrue(len(blockchain.get_blocks()) == 2)
 
+    def test_retrieve_blockchain(self):
+        blockchain = Blockchain(miner=False, unitTests=True)
+        for i in range(3):
+            transactions = [Transaction("K", "V"+str(i), "P"), Transaction("L"+str(i), i, "P")]
+            blockchain.get_blocks().append(Block(i + 1, transactions, time.time(), "0"))
+
+        self.assertTrue(blockchain.retrieve("K") == "V2")
+        self.assertTrue(blockchain.retrieve_all("K") == ["V2", "V1", "V0"])
+        self.assertTrue(blockchain.retrieve("Unknown") is None)
+        self.assertTrue(blockchain.is_ready())
+
+    def test_validate_chain(self):
+        chain = [Block(0, [], time.time(), "0", target=difficulty_to_target(1))]
+        for i in range(1, 50):
+            block = Block(i, [Transaction("K", i, "P")], time.time(), chain[-1].compute_hash(),
+                            target=difficulty_to_target(1))
+            while not block.proof():
+                block._change_nonce()
+            chain.append(block)
+
+        #Blocks decoded from JSON, so that the workers have to hash them
+        chain = [Block.from_dict(json.loads(json.dumps(block.to_dict(), cls=TransactionEncoder)))
+                 for block in chain]
+        self.assertTrue(validate_chain(chain)[0])
+        self.assertTrue(validate_chain(chain, processes=2, chunk_size=10)[0])
+        #Incremental validation from a checkpoint
+        valid, last_hash = validate_chain(chain[30:], chain[29].compute_hash())
+        self.assertTrue(valid and last_hash == chain[-1].compute_hash())
+
+        #Broken linkage
+        chain[25] = chain[26]
+        self.assertFalse(validate_chain(chain)[0])
+        self.assertFalse(validate_chain(chain, processes=2, chunk_size=10)[0])
+
+    def test_retarget_difficulty(self):
+        target = difficulty_to_target(2)
+        #Blocks mined twice slower than the block time
+        chain = [Block(i, [], 20.0 * i, "0", target=target) for i in range(10)]
+        self.assertTrue(next_target(chain, 10, 10) == target * 2)
+        #Blocks mined too fast, the adjustment is clamped
+        chain = [Block(i, [], 0.1 * i, "0", target=target) for i in range(10)]
+        self.assertTrue(next_target(chain, 10, 10) == target // 4)
+        #No adjustment between two retargeting heights
+        self.assertTrue(next_target(chain[:5], 10, 10) == target)
+        #No adjustment at all with a retargeting interval of 0
+        self.assertTrue(next_target(chain, 0, 10) == target)
+        blockchain = Blockchain(miner=False, unitTests=True, difficulty=0, retarget_interval=0)
+        for i in range(3):
+            blockchain.add_transaction(Transaction("K", i, "P"), broadcast=False)
+            blockchain._add_block(blockchain._new_block())
+        self.assertTrue(blockchain.is_valid() and len(blockchain.get_blocks()) == 3)
+        #Idle time does not lower the difficulty below the genesis one
+        chain = [Block(i, [], 100.0 * i, "0", target=target) for i in range(10)]
+        self.assertTrue(next_target(chain, 10, 10, max_target=target) == target)
+        #Cumulative work
+        self.assertTrue(block_work(difficulty_to_target(1)) == 16)
+
+        #The targets are checked before the first retargeting height
+        chain = [Block(0, [], 0, "0", target=difficulty_to_target(1))]
+        for i, difficulty in ((1, 1), (2, 0)):
+            block = Block(i, [], i, chain[-1].compute_hash(), target=difficulty_to_target(difficulty))
+            while not block.proof():
+                block._change_nonce()
+            chain.append(block)
+        self.assertTrue(validate_chain(chain[:2], retarget_interval=10, block_time=10)[0])
+        self.assertFalse(validate_chain(chain, retarget_interval=10, block_time=10)[0])
+        #The genesis target is checked
+        self.assertFalse(validate_chain(chain[:2], genesis_target=difficulty_to_target(2))[0])
+
+    def test_block_representation(self):
+        transaction = Transaction("K", {"V": [1, 2]}, "P")
+        with self.assertRaises(AttributeError):
+            transaction.value = "Other"
+        self.assertTrue(transaction == Transaction("K", {"V": [1, 2]}, "P"))
+
+        block = Block(1, [transaction], time.time(), "0")
+        block_hash = block.compute_hash()
+        block_json = json.dumps(block.to_dict(), cls=TransactionEncoder)
+        self.assertTrue(Block.from_dict(json.loads(block_json)).compute_hash() == block_hash)
+        #The cached hash follows the nonce
+        block._change_nonce()
+        self.assertTrue(block.compute_hash() != block_hash)
+        #The blocks are immutable, and a tampered block is detected by the validation
+        with self.assertRaises(AttributeError):
+            block._transactions = ()
+        chain = [Block(0, [], 0, "0")]
+        for i in range(1, 3):
+            chain.append(Block(i, [transaction], i, chain[-1].compute_hash()))
+        self.assertTrue(validate_chain(chain)[0])
+        object.__setattr__(chain[1], "_transactions", (Transaction("K", "Forged", "P"),))
+        self.assertFalse(validate_chain(chain)[0])
+
+    def test_snapshot(self):
+        blocks = []
+        for i in range(3):
+            transactions = [Transaction("K", "V"+str(i), "P"), Transaction(i, i, "P")]
+            blocks.append(Block(i, transactions, time.time(), "0"))
+
+        snapshot = Snapshot.empty(history=True).apply(blocks)
+        self.assertTrue(snapshot.retrieve("K") == "V2")
+        self.assertTrue(snapshot.retrieve(1) == 1)
+        self.assertTrue(snapshot.retrieve_all("K") == ["V2", "V1", "V0"])
+
+        #The hash survives a JSON round trip
+        copy = Snapshot.from_dict(json.loads(json.dumps(snapshot.to_dict())))
+        self.assertTrue(copy.compute_hash() == snapshot.compute_hash())
+        self.assertTrue(copy.retrieve(1) == 1)
+
+        #A node joins a node taking snapshots without pruning its chain
+        _, (peer, new_node) = make_nodes(2, joining=True, difficulty=1, snapshot_interval=3)
+        for i in range(8):
+            peer.add_transaction(Transaction("K", "V"+str(i), "P"), broadcast=False)
+            block = peer._new_block()
+            while not block.proof():
+                block._change_nonce()
+            peer._add_block(block)
+        self.assertTrue(peer.get_snapshot() is not None and peer.get_blocks()[0]._index == 0)
+        new_node.bootstrap(peer._get_ip())
+        self.assertTrue(len(new_node.get_blocks()) == len(peer.get_blocks()))
+        self.assertTrue(new_node.retrieve("K") == peer.retrieve("K"))
+        #The values of the blocks kept in the chain are not hidden by the snapshot
+        #(the last block is not committed yet)
+        values = ["V"+str(i) for i in reversed(range(7))]
+        self.assertTrue(peer.retrieve_all("K") == values)
+
+        #The values of the pruned blocks are found in the snapshot
+        pruned = Blockchain(miner=False, unitTests=True, difficulty=0, retarget_interval=2,
+                                snapshot_interval=3, prune=True)
+        pruned.add_transaction(Transaction("O", "X", "P"), broadcast=False)
+        for i in range(8):
+            pruned.add_transaction(Transaction("K", "V"+str(i), "P"), broadcast=False)
+            block = pruned._new_block()
+            while not block.proof():
+                block._change_nonce()
+            pruned._add_block(block)
+        self.assertTrue(pruned.get_blocks()[0]._index == 4)
+        self.assertTrue(pruned.retrieve("O") == "X" and pruned.retrieve_all("O") == ["X"])
+        self.assertTrue(pruned.retrieve_all("K") == values[:4])
+
+        #The messages delivered are remembered over two generations only
+        broadcast = Broadcast(set(), "127.0.0.1:0", heartbeat=False, max_messages=2)
+        sender = "127.0.0.1:1"
+        self.assertTrue(all(broadcast.deliver("transaction", m, sender)[0] for m in "ab"))
+        self.assertTrue(not broadcast.deliver("transaction", "a", sender)[0])
+        broadcast.rotate()
+        self.assertTrue(not broadcast.deliver("transaction", "a", sender)[0])
+        broadcast.rotate()
+        self.assertTrue(broadcast.deliver("transaction", "a", sender)[0])
+
+    def test_metrics(self):
+        counter = Counter("test_total", "Test counter")
+        counter.inc(peer="A")
+        counter.inc(2, peer="A")
+        self.assertTrue('test_total{peer="A"} 3.0' in counter.render())
+
+        histogram = Histogram("test_seconds", "Test histogram", buckets=[0.1, 1])
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = histogram.render()
+        self.assertTrue('test_seconds_bucket{le="0.1"} 0' in lines)
+        self.assertTrue('test_seconds_bucket{le="1.0"} 1' in lines)
+        self.assertTrue('test_seconds_bucket{le="+Inf"} 2' in lines)
+        self.assertTrue('test_seconds_count 2' in lines)
+
+    def test_profiler(self):
+        def busy(profiler, subsystem):
+            with profiler.profile(subsystem):
+                end = time.time() + 0.2
+                while time.time() < end:
+                    Block(0, [], 0, "0").compute_hash()
+
+        #Two threads are profiled at the same time
+        profiler = Profiler(interval=0.001)
+        thread = threading.Thread(target=busy, args=(profiler, "miner"))
+        thread.start()
+        busy(profiler, "request /put")
+        thread.join()
+        self.assertTrue(profiler.subsystems() == ["miner", "request /put"])
+        for subsystem in profiler.subsystems():
+            self.assertTrue("(busy)" in profiler.dump(subsystem))
+
+    def test_compact_block(self):
+        network, (sender, receiver) = make_nodes(2)
+        genesis = sender.get_blocks()[0]
+        receiver._set_chain([genesis], genesis.compute_hash())
+
+        transactions = [Transaction("K"+str(i), "V"+str(i), "P") for i in range(5)]
+        for transaction in transactions:
+            sender.add_transaction(transaction, broadcast=False)
+        for transaction in transactions[:3]:
+            receiver.add_transaction(transaction, broadcast=False)
+        block = sender._new_block()
+        sender._add_block(block)
+
+        #Only the two missing transactions are fetched from the sender
+        compact = json.loads(json.dumps(block.to_compact_dict()))
+        self.assertTrue("_transactions" not in compact)
+        rebuilt = receiver._rebuild_block(compact, sender._get_ip())
+        self.assertTrue(rebuilt.compute_hash() == block.compute_hash())
+        self.assertTrue(network.statistics()[0] == {"blockTransactions": 1})
+        self.assertTrue(receiver.get_block_transactions(block.compute_hash(), [0]) is None)
+        self.assertTrue(receiver.confirm_block(rebuilt))
+        self.assertTrue(receiver.get_block_transactions(block.compute_hash(), [4]) == [transactions[4]])
+
+        #A compact block that does not match its transactions is rejected
+        tampered = dict(compact, _timestamp=compact["_timestamp"] + 1)
+        self.assertTrue(receiver._rebuild_block(tampered, sender._get_ip()) is None)
+        #and so is an answer without one transaction per index
+        for transaction in transactions:
+            sender.add_transaction(Transaction(transaction.key, "W", "P"), broadcast=False)
+        block = sender._new_block()
+        sender._add_block(block)
+        sender.get_block_transactions = lambda block_hash, indexes: transactions[:1]
+        compact = json.loads(json.dumps(block.to_compact_dict()))
+        self.assertTrue(receiver._rebuild_block(compact, sender._get_ip()) is None)
+
+        #Delivered synchronously, a mined block is rebuilt from its miner at once
+        network, (sender, receiver) = make_nodes(
+            2, SimulatedNetwork(VirtualClock(), synchronous=True))
+        genesis = sender.get_blocks()[0]
+        receiver._set_chain([genesis], genesis.compute_hash())
+        sender.add_node(receiver._get_ip())
+        receiver.add_node(sender._get_ip())
+        transaction = Transaction("S", "V", "P")
+        sender.add_transaction(transaction, broadcast=False)
+        block = sender._new_block()
+        sender._publish_block(block)
+        self.assertTrue(network.statistics()[0]["blockTransactions"] == 1)
+        self.assertTrue(receiver.get_block_transactions(block.compute_hash(), [0]) == [transaction])
+
+    def test_parallel_sync(self):
+        network, nodes = make_nodes(4, joining=True, sync_range=4)
+        peers, new_node = nodes[:3], nodes[3]
+
+        for i in range(20):
+            peers[0].add_transaction(Transaction("K"+str(i), "V"+str(i), "P"), broadcast=False)
+            peers[0]._add_block(peers[0]._new_block())
+        chain = peers[0].get_blocks()
+        for peer in peers:
+            peer._set_chain(list(chain), chain[-1].compute_hash())
+            for other in peers:
+                peer.add_node(other._get_ip())
+        #A peer fails to send its blocks, its ranges are retried on the others
+        peers[1].get_block_range = lambda start, end: None
+
+        new_node.bootstrap(peers[0]._get_ip())
+        self.assertTrue([b.compute_hash() for b in new_node.get_blocks()] ==
+                        [b.compute_hash() for b in chain])
+        messages = network.statistics()[0]
+        #5 ranges of 4 blocks, at least one of them retried
+        self.assertTrue(messages["blocks"] >= 6 and messages["headers"] == 1)
+        self.assertTrue("blockchain" not in messages)
+
+    def test_admission_control(self):
+        now = [0.0]
+        admission = AdmissionControl(rate=2, burst=3, clock=lambda: now[0])
+        self.assertTrue(all(admission.admit("A", 0) is None for i in range(3)))
+        self.assertTrue(admission.admit("A", 0) == ("rate", 0.5))
+        #The clients have their own bucket
+        self.assertTrue(admission.admit("B", 0) is None)
+        now[0] += 0.5
+        self.assertTrue(admission.admit("A", 0) is None)
+        #The number of buckets is bounded, the least recently used is dropped
+        admission = AdmissionControl(rate=2, burst=3, max_clients=2, clock=lambda: now[0])
+        for client in range(5):
+            admission.admit(client, 0)
+        self.assertTrue(list(admission._buckets) == [3, 4])
+
+        #The rate is limited by client address, whatever the origin
+        blockchain = Blockchain(miner=False, unitTests=True, rate_limit=1, rate_burst=1)
+        self.assertTrue(blockchain.submit_transaction(Transaction("K", 0, "P"), "10.0.0.1") is None)
+        self.assertTrue(blockchain.submit_transaction(Transaction("K", 1, "Q"), "10.0.0.1") is not None)
+
+        blockchain = Blockchain(miner=False, unitTests=True, max_pending=2, block_time=5)
+        for i in range(2):
+            self.assertTrue(blockchain.submit_transaction(Transaction("K", i, "P")) is None)
+        self.assertTrue(blockchain.submit_transaction(Transaction("K", 2, "P")) == 5)
+        self.assertTrue(len(blockchain.get_pending_transactions()) == 2)
+        #The delay asked by the node is honored, the backoff is bounded
+        self.assertTrue(5 <= backoff_delay(0, 5) <= 6.25)
+        self.assertTrue(backoff_delay(20) <= 37.5)
+
+    def test_out_of_line_values(self):
+        store = ValueStore(threshold=100, compression="zlib")
+        self.assertTrue(store.externalize("small") == "small")
+        value = {"text": "x" * 1000}
+        reference = store.externalize(value)
+        self.assertTrue(is_reference(reference) and len(json.dumps(reference)) < 100)
+        self.assertTrue(store.resolve(reference) == value)
+        #The values received are checked against their hash
+        encoding, data = store.get(reference["__ref__"])
+        copy = ValueStore()
+        self.assertTrue(not copy.put("0" * 64, encoding, data))
+        self.assertTrue(copy.put(reference["__ref__"], encoding, data))
+        self.assertTrue(copy.resolve(reference) == value)
+        #The values no longer referenced are dropped, but not the recent ones
+        store.externalize({"text": "y" * 1000})
+        self.assertTrue(store.collect(set()) == 0)
+        self.assertTrue(store.collect({reference["__ref__"]}) == 1)
+        self.assertTrue(store.resolve(reference) == value)
+
+        #A node missing a value fetches it from its peers
+        _, nodes = make_nodes(2, value_threshold=100, compression="zlib")
+        nodes[0].submit_transaction(Transaction("K", value, "P"))
+        transaction = nodes[0].get_pending_transactions()[0]
+        self.assertTrue(transaction.value == reference)
+        nodes[1].add_node(nodes[0]._get_ip())
+        self.assertTrue(nodes[1]._resolve(transaction.value) == value)
+
+    def test_simulation(self):
+        simulation = Simulation(nodes=20, block_time=10, rate=2, seed=1)
+        simulation.crash(simulation.nodes[-1], at=50)
+        simulation.run(200)
+        report = simulation.report()
+        self.assertTrue(report["live_nodes"] == 19)
+        self.assertTrue(report["blocks_committed"] > 0 and report["committed"] > 0)
+        self.assertTrue(0 <= report["fork_rate"] < 1)
+        self.assertTrue(0.01 <= report["propagation_p50"] <= 0.1)
+        #Without losses nor partitions, all the live nodes agree on the master chain
+        self.assertTrue(report["consistent_nodes"] == 19)
+        #The crashed node is suspected by the others
+        self.assertTrue(simulation.nodes[-1]._get_ip() not in simulation.nodes[0].get_peers())
+
 
 
 if __name__ == '__main__':
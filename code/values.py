@@ -0,0 +1,129 @@
+"""
+Out-of-line storage of the large values of the transactions.
+
+A value larger than the threshold is kept in a content-addressed store, the
+transaction only holding a reference to it: {"__ref__": <sha256 of the value>}.
+The blocks, the broadcasts and the proofs of work then only carry the hash,
+the value being pushed once to the peers and fetched on demand (`/value`).
+"""
+import base64
+import json
+import threading
+import zlib
+from hashlib import sha256
+
+
+REFERENCE = "__ref__"
+ENCODINGS = ("none", "zlib")
+
+
+def is_reference(value):
+    """
+    Returns True if the value of a transaction is a reference to a stored value.
+    """
+    return isinstance(value, dict) and REFERENCE in value
+
+
+def encode(data, encoding):
+    """
+    Returns the text sent to the other nodes for the JSON of a value.
+    """
+    if encoding == "zlib":
+        return base64.b64encode(zlib.compress(data.encode())).decode()
+    return data
+
+
+def decode(text, encoding):
+    """
+    Returns the JSON of a value sent by another node (see `encode`).
+    """
+    if encoding == "zlib":
+        return zlib.decompress(base64.b64decode(text)).decode()
+    if encoding == "none":
+        return text
+    raise ValueError("Unknown encoding {}".format(encoding))
+
+
+class ValueStore:
+    def __init__(self, threshold = 0, compression = "none"):
+        """Init the store. The values whose JSON is longer than `threshold`
+        characters (0 to keep all the values inline) are stored out of line,
+        compressed with `compression` {none, zlib}.
+        """
+        if compression not in ENCODINGS:
+            raise ValueError("Unknown compression {}".format(compression))
+        self._threshold = threshold
+        self._compression = compression
+        self._values = {} #Encoded JSON of the values by hash
+        self._recent = set() #Hashes of the values stored since the last collection
+        self._lock = threading.Lock()
+
+    def externalize(self, value):
+        """
+        Returns the value to put in a transaction: the value itself, or a
+        reference once it is stored. The values that look like a reference
+        are always stored, so that every reference in the chain is one.
+        """
+        if not self._threshold and not is_reference(value):
+            return value
+        data = json.dumps(value, sort_keys=True)
+        if len(data) <= self._threshold and not is_reference(value):
+            return value
+        value_hash = sha256(data.encode()).hexdigest()
+        with self._lock:
+            if value_hash not in self._values:
+                self._values[value_hash] = encode(data, self._compression)
+            self._recent.add(value_hash)
+        return {REFERENCE: value_hash}
+
+    def get(self, value_hash):
+        """
+        Returns the encoding and the encoded JSON of a stored value,
+        None if it is unknown.
+        """
+        with self._lock:
+            text = self._values.get(value_hash)
+        if text is None:
+            return None
+        return self._compression, text
+
+    def put(self, value_hash, encoding, text):
+        """
+        Stores a value received from another node.
+        Returns False if it does not match its hash.
+        """
+        try:
+            data = decode(text, encoding)
+        except (ValueError, zlib.error):
+            return False
+        if sha256(data.encode()).hexdigest() != value_hash:
+            return False
+        with self._lock:
+            self._values[value_hash] = encode(data, self._compression)
+            self._recent.add(value_hash)
+        return True
+
+    def resolve(self, value):
+        """
+        Returns the original value of a transaction value.
+        Raises a KeyError if it references an unknown value.
+        """
+        if not is_reference(value):
+            return value
+        with self._lock:
+            text = self._values[value[REFERENCE]]
+        return json.loads(decode(text, self._compression))
+
+    def collect(self, referenced):
+        """
+        Drops the values that are not in the `referenced` hashes, except the
+        ones stored since the last collection (their transaction may not be
+        in the pool yet). Returns the number of values dropped.
+        """
+        with self._lock:
+            kept = {value_hash: text for value_hash, text in self._values.items()
+                    if value_hash in referenced or value_hash in self._recent}
+            dropped = len(self._values) - len(kept)
+            self._values = kept
+            self._recent = set()
+        return dropped